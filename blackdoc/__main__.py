@@ -1,17 +1,24 @@
 import argparse
 import pathlib
+import re
 import sys
 
 import black
 from rich.text import Text
 
-from blackdoc import __version__, format_lines, formats
-from blackdoc.blackcompat import decode_bytes, read_pyproject_toml
+from blackdoc import __version__, backends, formats
+from blackdoc.blackcompat import read_pyproject_toml
+from blackdoc.blacken import blacken_spans, statistics
+from blackdoc.blacken import options as blacken_options
+from blackdoc.cache import Cache, StableUnits, UnitStore, cache_key
+from blackdoc.classification import classify
 from blackdoc.colors import DiffHighlighter
+from blackdoc.concurrency import process_sources, schedule_chunks, schedule_units
 from blackdoc.console import err, out
 from blackdoc.diff import unified_diff
-from blackdoc.files import collect_files
+from blackdoc.files import collect_files, read_file
 from blackdoc.report import Report
+from blackdoc.spans import splice
 
 diff_highlighter = DiffHighlighter()
 
@@ -29,64 +36,108 @@ def check_format_names(string):
     return names
 
 
-def format_and_overwrite(path, mode):
-    try:
-        with open(path, mode="rb") as f:
-            content, encoding, newline = decode_bytes(f.read(), mode)
+def check_format_patterns(string):
+    # only split at commas followed by a format name, such that regular
+    # expressions can contain commas
+    pairs = re.split(r",(?=[-\w]+=)", string)
 
-        lines = content.split("\n")
+    patterns = {}
+    for pair in pairs:
+        name, sep, pattern = pair.partition("=")
+        if not sep:
+            raise argparse.ArgumentTypeError(
+                f"invalid format pattern: {pair!r} (expected FMT=REGEX)"
+            )
 
-        new_content = "\n".join(format_lines(lines, mode))
+        check_format_names(name)
+        patterns[name] = pattern
 
-        if new_content == content:
-            result = "unchanged"
-        else:
-            err.print(f"reformatted {path}", style="bold", highlight=False)
-            result = "reformatted"
+    return patterns
 
-            with open(path, "w", encoding=encoding, newline=newline) as f:
-                f.write(new_content)
-    except (black.InvalidInput, formats.InvalidFormatError) as e:
-        err.print(
-            f"error: cannot format {path.absolute()}: {e}", style="red", highlight=False
+
+def check_workers(string):
+    try:
+        workers = int(string)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: {string!r}")
+
+    if workers < 1:
+        raise argparse.ArgumentTypeError(
+            f"invalid number of workers: {workers} (must be at least 1)"
         )
-        result = "error"
+    return workers
 
-    return result
 
+def report_error(path, error):
+    err.print(
+        f"error: cannot format {path.absolute()}: {error}", style="red", highlight=False
+    )
+    return "error"
 
-def format_and_check(path, mode, diff=False, color=False):
-    try:
-        with open(path, mode="rb") as f:
-            content, _, _ = decode_bytes(f.read(), mode)
 
-        lines = content.split("\n")
+def overwrite(path, content, new_content, encoding, newline):
+    if new_content == content:
+        return "unchanged"
+
+    err.print(f"reformatted {path}", style="bold", highlight=False)
+
+    with open(path, "w", encoding=encoding, newline=newline) as f:
+        f.write(new_content)
+
+    return "reformatted"
+
 
-        new_content = "\n".join(format_lines(lines, mode))
+def check(path, content, new_content, encoding, newline, diff=False, color=False):
+    if new_content == content:
+        return "unchanged"
 
-        if new_content == content:
-            result = "unchanged"
+    err.print(f"would reformat {path}", style="bold", highlight=False)
+
+    if diff:
+        diff_ = unified_diff(content, new_content, path)
+
+        if color:
+            formatted_diff = diff_highlighter(diff_)
         else:
-            err.print(f"would reformat {path}", style="bold", highlight=False)
+            formatted_diff = Text(diff_)
+
+        out.print(formatted_diff)
+
+    return "reformatted"
 
-            if diff:
-                diff_ = unified_diff(content, new_content, path)
 
-                if color:
-                    formatted_diff = diff_highlighter(diff_)
-                else:
-                    formatted_diff = Text(diff_)
+def format_content(content, mode, path=None):
+    labeled = classify(content, path=path)
 
-                out.print(formatted_diff)
+    return splice(content, blacken_spans(content, labeled, mode=mode))
+
+
+def format_and_overwrite(path, mode):
+    try:
+        decoded = read_file(path, mode)
+        if decoded is None:
+            return "unchanged"
 
-            result = "reformatted"
+        content, encoding, newline = decoded
+        new_content = format_content(content, mode, path=path)
     except (black.InvalidInput, formats.InvalidFormatError) as e:
-        err.print(
-            f"error: cannot format {path.absolute()}: {e}", style="red", highlight=False
-        )
-        result = "error"
+        return report_error(path, e)
+
+    return overwrite(path, content, new_content, encoding, newline)
+
 
-    return result
+def format_and_check(path, mode, diff=False, color=False):
+    try:
+        decoded = read_file(path, mode)
+        if decoded is None:
+            return "unchanged"
+
+        content, encoding, newline = decoded
+        new_content = format_content(content, mode, path=path)
+    except (black.InvalidInput, formats.InvalidFormatError) as e:
+        return report_error(path, e)
+
+    return check(path, content, new_content, encoding, newline, diff=diff, color=color)
 
 
 def process(args):
@@ -104,6 +155,26 @@ def process(args):
     if disabled_formats:
         formats.disable(disabled_formats)
 
+    format_patterns = getattr(args, "format_patterns", {})
+    for name, pattern in format_patterns.items():
+        if name not in formats.detection_funcs:
+            continue
+
+        try:
+            re.compile(pattern)
+        except re.error:
+            err.print(
+                f"Invalid regular expression for format {name} given: {pattern!r}",
+                style="red",
+            )
+            return 2
+
+        if pattern:
+            formats.detection_patterns[name] = pattern
+        else:
+            # an empty pattern means the format can appear in any file
+            formats.detection_patterns.pop(name, None)
+
     try:
         include_regex = black.re_compile_maybe_verbose(args.include)
     except black.re.error:
@@ -172,17 +243,101 @@ def process(args):
     )
 
     actions = {
-        "inplace": format_and_overwrite,
-        "check": format_and_check,
+        "inplace": (format_and_overwrite, overwrite),
+        "check": (format_and_check, check),
     }
     action_kwargs = {"diff": args.diff, "color": args.color} if args.diff else {}
 
-    action = actions.get(args.action)
+    action, finish = actions.get(args.action)
 
-    changed_sources = {
-        source: action(source.resolve(), mode, **action_kwargs)
-        for source in sorted(sources)
-    }
+    blacken_options["strings_only"] = getattr(args, "strings_only", False)
+    blacken_options["batch_prompts"] = getattr(args, "batch_prompts", False)
+    blacken_options["batch_units"] = getattr(args, "batch_units", False)
+    blacken_options["safe"] = getattr(args, "safe", False)
+    blacken_options["infer_target_versions"] = getattr(
+        args, "infer_target_versions", False
+    )
+    backend = getattr(args, "backend", "black")
+    blacken_options["backend"] = backend
+    blacken_options["backend_options"] = (
+        {"url": getattr(args, "blackd_url", backends.default_blackd_url)}
+        if backend == "blackd"
+        else {}
+    )
+
+    cache_dir = getattr(args, "cache_dir", None)
+    use_cache = getattr(args, "cache", True)
+    if use_cache:
+        cache = Cache.read(
+            cache_key(
+                mode,
+                strings_only=blacken_options["strings_only"],
+                infer_target_versions=blacken_options["infer_target_versions"],
+                backend=backend,
+            ),
+            cache_dir,
+        )
+        sources, cached_sources = cache.filtered_cached(sources)
+    else:
+        cached_sources = set()
+
+    if args.verbose:
+        for source in sorted(cached_sources):
+            err.print(
+                f"{source} wasn't modified on disk since last run.", highlight=False
+            )
+
+    # the persistent stores assume the results of the local version of black
+    unit_store = (
+        UnitStore.open(cache_dir, max_entries=getattr(args, "unit_store_size", 100_000))
+        if getattr(args, "unit_store", False) and backend == "black"
+        else None
+    )
+    blacken_options["unit_store"] = unit_store
+
+    stable_units = (
+        StableUnits.open(cache_dir)
+        if getattr(args, "stable_units", False) and backend == "black"
+        else None
+    )
+    blacken_options["stable_units"] = stable_units
+
+    workers = getattr(args, "workers", 1)
+    schedule = getattr(args, "schedule", "files")
+    try:
+        if schedule == "units":
+            changed_sources = schedule_units(
+                finish, report_error, sources, mode, action_kwargs, workers=workers
+            )
+        elif schedule == "chunks":
+            changed_sources = schedule_chunks(
+                finish, report_error, sources, mode, action_kwargs, workers=workers
+            )
+        else:
+            changed_sources = process_sources(
+                action, sources, mode, action_kwargs, workers=workers
+            )
+    except backends.BackendError as e:
+        # the backend is not usable, so every other file would fail as well
+        err.print(f"error: {e}", style="red", highlight=False)
+        return 123
+
+    if unit_store is not None:
+        unit_store.close()
+    if stable_units is not None:
+        stable_units.close()
+
+    if use_cache:
+        formatted_results = (
+            {"unchanged"} if args.action == "check" else {"unchanged", "reformatted"}
+        )
+        cache.write(
+            source
+            for source, result in changed_sources.items()
+            if result in formatted_results
+        )
+
+    changed_sources.update(dict.fromkeys(cached_sources, "unchanged"))
 
     conditional = args.action == "check"
     report = Report.from_sources(changed_sources, conditional=conditional)
@@ -194,6 +349,20 @@ def process(args):
     else:
         return_code = 0
 
+    if args.verbose:
+        hits = statistics["unit cache hits"]
+        misses = statistics["unit cache misses"]
+        err.print(f"code unit cache: {hits} hits, {misses} misses", highlight=False)
+
+        if unit_store is not None:
+            hits = statistics["unit store hits"]
+            misses = statistics["unit store misses"]
+            err.print(f"code unit store: {hits} hits, {misses} misses", highlight=False)
+
+        if stable_units is not None:
+            stable = statistics["stable units"]
+            err.print(f"stable code units: {stable}", highlight=False)
+
     error_message = "Oh no! :boom: :broken_heart: :boom:"
     no_error_message = "All done! :sparkles: :cake: :sparkles:"
     err.print()
@@ -332,6 +501,166 @@ def main():
         ),
         default=argparse.SUPPRESS,
     )
+    parser.add_argument(
+        "--format-patterns",
+        metavar="FMT=REGEX[,FMT=REGEX...]",
+        type=check_format_patterns,
+        help=(
+            "Override the regular expressions that select the files a format is"
+            " detected in.  An empty value means the format is detected in all"
+            " files."
+        ),
+        default=argparse.SUPPRESS,
+    )
+    parser.add_argument(
+        "--strings-only",
+        "--no-strings-only",
+        dest="strings_only",
+        action=boolean_flag,
+        default=False,
+        help=(
+            "Only look for code units in the string literals of python files."
+            "  Files that can't be tokenized are searched completely."
+        ),
+    )
+    parser.add_argument(
+        "--infer-target-versions",
+        "--no-infer-target-versions",
+        dest="infer_target_versions",
+        action=boolean_flag,
+        default=False,
+        help=(
+            "If no target versions are given, infer them once from all code units"
+            " of a file instead of separately for each code unit."
+        ),
+    )
+    parser.add_argument(
+        "--batch-prompts",
+        "--no-batch-prompts",
+        dest="batch_prompts",
+        action=boolean_flag,
+        default=False,
+        help=(
+            "Format consecutive doctest and ipython prompts with a single call to"
+            " black.  Only used if the target versions are given explicitly or"
+            " inferred for the whole file."
+        ),
+    )
+    parser.add_argument(
+        "--batch-units",
+        "--no-batch-units",
+        dest="batch_units",
+        action=boolean_flag,
+        default=False,
+        help=(
+            "Join the code units of a file with the same settings into a single"
+            " module, separated by sentinel statements, and format it with a single"
+            " call to the backend.  Only used if the target versions are given"
+            " explicitly or inferred for the whole file.  Only helps with the"
+            " blackd and ruff backends, it makes the default black backend"
+            " slower."
+        ),
+    )
+    safety = parser.add_mutually_exclusive_group()
+    safety.add_argument(
+        "--safe",
+        dest="safe",
+        action="store_true",
+        default=False,
+        help=(
+            "Check that every reformatted code unit is equivalent to the original"
+            " code and stable."
+        ),
+    )
+    safety.add_argument(
+        "--fast",
+        dest="safe",
+        action="store_false",
+        help="Skip the checks of --safe (the default).",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=sorted(backends.format_funcs),
+        default="black",
+        help=(
+            "The formatter used for the code units.  blackd requires a running"
+            " blackd server, and ruff formats all code units of a file with the"
+            " same settings in a single call."
+        ),
+    )
+    parser.add_argument(
+        "--blackd-url",
+        metavar="URL",
+        type=str,
+        default=backends.default_blackd_url,
+        help="The url of the blackd server used by the blackd backend.",
+    )
+    parser.add_argument(
+        "-W",
+        "--workers",
+        metavar="INT",
+        type=check_workers,
+        default=1,
+        help="Number of worker processes used to format files in parallel.",
+    )
+    parser.add_argument(
+        "--schedule",
+        choices=["files", "units", "chunks"],
+        default="files",
+        help=(
+            "How to distribute the work between the workers: whole files,"
+            " individual code units, or chunks of files.  Scheduling code units"
+            " balances the load for very large files, while splitting large"
+            " files into chunks also distributes their classification."
+        ),
+    )
+    parser.add_argument(
+        "--cache",
+        "--no-cache",
+        dest="cache",
+        action=boolean_flag,
+        default=True,
+        help="Skip files that were not modified since they were last formatted.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        metavar="PATH",
+        type=pathlib.Path,
+        default=argparse.SUPPRESS,
+        help=(
+            "Where to store the cache.  (default: the value of $BLACKDOC_CACHE_DIR"
+            " or the user cache directory)"
+        ),
+    )
+    parser.add_argument(
+        "--unit-store",
+        "--no-unit-store",
+        dest="unit_store",
+        action=boolean_flag,
+        default=False,
+        help=(
+            "Store formatted code units in the cache directory and reuse them"
+            " across files and runs."
+        ),
+    )
+    parser.add_argument(
+        "--unit-store-size",
+        metavar="INT",
+        type=int,
+        default=100_000,
+        help="The maximum number of code units kept in the unit store.",
+    )
+    parser.add_argument(
+        "--stable-units",
+        "--no-stable-units",
+        dest="stable_units",
+        action=boolean_flag,
+        default=False,
+        help=(
+            "Remember the code units black doesn't change in the cache directory"
+            " and skip black for them in later runs."
+        ),
+    )
     parser.add_argument(
         "-S",
         "--skip-string-normalization",
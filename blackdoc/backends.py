@@ -0,0 +1,195 @@
+"""formatters used to format the extracted code
+
+Every backend has a function that formats a single code unit with a
+``black.Mode``, and optionally a function that formats many code units with
+the same mode at once. Code that can't be parsed raises ``black.InvalidInput``
+with a message in the format used by ``black``, all other failures raise
+``BackendError``.
+"""
+
+import http.client
+import re
+import shutil
+import subprocess
+import tempfile
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+import black
+
+format_funcs = {}
+batch_funcs = {}
+
+default_blackd_url = "http://localhost:45484"
+ruff_error_re = re.compile(
+    r"Failed to parse .*?(?P<index>\d+)\.pyi?:(?P<line>\d+):(?P<column>\d+):"
+    r" (?P<message>.*)$",
+    flags=re.MULTILINE,
+)
+
+
+class BackendError(Exception):
+    """the backend failed to format the code"""
+
+
+def register_backend(name, format_func, batch_func=None):
+    format_funcs[name] = format_func
+    if batch_func is not None:
+        batch_funcs[name] = batch_func
+
+
+def format_black(code, mode):
+    return black.format_str(code, mode=mode)
+
+
+def blackd_headers(mode):
+    """translate the mode to the headers understood by ``blackd``"""
+    headers = {
+        "X-Protocol-Version": "1",
+        "X-Line-Length": str(mode.line_length),
+        # the result is verified by blackdoc, if requested
+        "X-Fast-Or-Safe": "fast",
+    }
+    if not mode.string_normalization:
+        headers["X-Skip-String-Normalization"] = "1"
+    if not mode.magic_trailing_comma:
+        headers["X-Skip-Magic-Trailing-Comma"] = "1"
+    if mode.preview:
+        headers["X-Preview"] = "1"
+    if mode.is_pyi:
+        headers["X-Python-Variant"] = "pyi"
+    elif mode.target_versions:
+        headers["X-Python-Variant"] = ",".join(
+            sorted(version.name.lower() for version in mode.target_versions)
+        )
+
+    return headers
+
+
+def format_blackd(code, mode, url=default_blackd_url):
+    """format the code using a ``blackd`` server"""
+    request = urllib.request.Request(
+        url, data=code.encode(), headers=blackd_headers(mode), method="POST"
+    )
+    try:
+        with urllib.request.urlopen(request) as response:
+            status = response.status
+            body = response.read().decode()
+    except urllib.error.HTTPError as e:
+        status = e.code
+        body = e.read().decode()
+    except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+        raise BackendError(f"cannot connect to blackd at {url}: {e}") from e
+
+    if status == 204:
+        # the code is already formatted
+        return code
+    elif status == 200:
+        return body
+    elif status == 400:
+        raise black.InvalidInput(body)
+    else:
+        raise BackendError(f"blackd failed with status {status}: {body}")
+
+
+def ruff_config(mode):
+    """translate the mode to ``ruff format`` configuration options
+
+    Other settings of the mode are not supported by ``ruff``.
+    """
+    settings = {
+        "line-length": max(mode.line_length, 1),
+        "format.quote-style": "'preserve'" if not mode.string_normalization else None,
+        "format.skip-magic-trailing-comma": (
+            "true" if not mode.magic_trailing_comma else None
+        ),
+        "format.preview": "true" if mode.preview else None,
+    }
+    if mode.target_versions:
+        # ruff takes the minimum supported version
+        oldest = min(mode.target_versions, key=lambda version: version.value)
+        minor = int(oldest.name.removeprefix("PY3"))
+        settings["target-version"] = f"'py3{max(minor, 7)}'"
+
+    return [
+        argument
+        for name, value in settings.items()
+        if value is not None
+        for argument in ("--config", f"{name} = {value}")
+    ]
+
+
+def ruff_executable():
+    executable = shutil.which("ruff")
+    if executable is None:
+        raise BackendError("cannot find the ruff executable")
+
+    return executable
+
+
+def format_ruff_batch(codes, mode):
+    """format the code units using a single call to ``ruff format``
+
+    The code units are written to a temporary directory. Returns the
+    formatted code units, or the ``black.InvalidInput`` exceptions for code
+    units that can't be parsed.
+    """
+    suffix = ".pyi" if mode.is_pyi else ".py"
+    with tempfile.TemporaryDirectory(prefix="blackdoc-") as directory:
+        paths = [Path(directory) / f"{index}{suffix}" for index in range(len(codes))]
+        for path, code in zip(paths, codes):
+            path.write_text(code, encoding="utf-8")
+
+        try:
+            process = subprocess.run(
+                [
+                    ruff_executable(),
+                    "format",
+                    "--no-cache",
+                    "--isolated",
+                    *ruff_config(mode),
+                    directory,
+                ],
+                capture_output=True,
+                text=True,
+            )
+        except OSError as e:
+            raise BackendError(f"cannot run ruff: {e}") from e
+
+        errors = {}
+        for match in ruff_error_re.finditer(process.stderr):
+            index = int(match.group("index"))
+            line_number = int(match.group("line"))
+            lines = codes[index].split("\n")
+            faulty_line = (
+                lines[line_number - 1]
+                if line_number <= len(lines) and lines[line_number - 1].strip()
+                else match.group("message")
+            )
+            # ruff's columns are 1-based, black's are 0-based
+            column = int(match.group("column")) - 1
+            errors[index] = black.InvalidInput(
+                f"Cannot parse: {line_number}:{column}: {faulty_line}"
+            )
+
+        if process.returncode != 0 and not errors:
+            raise BackendError(f"ruff failed: {process.stderr.strip()}")
+
+        return [
+            errors[index] if index in errors else path.read_text(encoding="utf-8")
+            for index, path in enumerate(paths)
+        ]
+
+
+def format_ruff(code, mode):
+    (result,) = format_ruff_batch([code], mode)
+    if isinstance(result, Exception):
+        raise result
+
+    return result
+
+
+register_backend("black", format_black)
+register_backend("blackd", format_blackd)
+register_backend("ruff", format_ruff, format_ruff_batch)
@@ -1,10 +1,27 @@
-import copy
+import collections
+import dataclasses
+import functools
+import io
+import itertools
 import re
+import tokenize
 
 import black
+import more_itertools
 from blib2to3.pgen2.tokenize import TokenError
 
+from blackdoc.backends import batch_funcs, format_funcs
+from blackdoc.cache import stable_result
 from blackdoc.formats import extract_code, reformat_code
+from blackdoc.formats.doctest import scan_code_unit
+from blackdoc.spans import unit_spans
+
+# older versions of black raise `AssertionError` for unsafe code
+safety_errors = (AssertionError, getattr(black, "ASTSafetyError", AssertionError))
+
+
+class UnsafeFormattingError(black.InvalidInput):
+    """the formatted code is not equivalent to the original code or not stable"""
 
 
 def parse_message(message):
@@ -27,49 +44,686 @@ def parse_message(message):
     return tuple(types[key](value) for key, value in match.groupdict().items())
 
 
+class UnitCache:
+    """bounded mapping that evicts the least recently used entries"""
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.data = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key):
+        value = self.data.get(key)
+        if value is not None:
+            self.data.move_to_end(key)
+
+        return value
+
+    def set(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+
+# code units are repeated a lot in documentation, so keep the formatted
+# versions of the most recently formatted units
+unit_cache = UnitCache()
+statistics = collections.Counter()
+
+# settings of the formatting engine, set by the CLI
+options = {
+    # persistent store shared between runs, see `blackdoc.cache.UnitStore`
+    "unit_store": None,
+    # code units known to be unchanged by black, see
+    # `blackdoc.cache.StableUnits`
+    "stable_units": None,
+    # only classify the string literals of python files
+    "strings_only": False,
+    # format consecutive prompts in a single call to black
+    "batch_prompts": False,
+    # format all code units with the same mode in a single call to black
+    "batch_units": False,
+    # infer the target versions from all code units of a file
+    "infer_target_versions": False,
+    # check that the formatted code is equivalent and stable
+    "safe": False,
+    # the formatter, see `blackdoc.backends`
+    "backend": "black",
+    # additional arguments passed to the functions of the backend
+    "backend_options": {},
+}
+
+# formats where consecutive code units are formatted together
+batched_formats = ("doctest", "ipython")
+leading_string_re = re.compile(r"^[rRbBuUfFtT]{0,2}['\"]")
+# the statements separating joined code units
+sentinel_prefix = "__blackdoc_sentinel_"
+# the maximum number of code units joined into a single module
+max_joined_units = 128
+
+
+def drain_statistics():
+    """return the collected statistics and reset them"""
+    drained = statistics.copy()
+    statistics.clear()
+
+    return drained
+
+
+def lookup(code, mode):
+    """search the previous results for the formatted code"""
+    key = (code, mode)
+
+    blackened = unit_cache.get(key)
+    if blackened is not None:
+        statistics["unit cache hits"] += 1
+        return blackened
+
+    statistics["unit cache misses"] += 1
+
+    stable_units = options["stable_units"]
+    if stable_units is not None and (code, mode) in stable_units:
+        statistics["stable units"] += 1
+        blackened = stable_result(code)
+        unit_cache.set(key, blackened)
+        return blackened
+
+    unit_store = options["unit_store"]
+    if unit_store is not None:
+        blackened = unit_store.get(code, mode)
+        if blackened is not None:
+            statistics["unit store hits"] += 1
+            unit_cache.set(key, blackened)
+            return blackened
+
+        statistics["unit store misses"] += 1
+
+    return None
+
+
+def remember(code, mode, blackened):
+    unit_cache.set((code, mode), blackened)
+
+    stable_units = options["stable_units"]
+    if stable_units is not None and blackened == stable_result(code):
+        stable_units.add(code, mode)
+
+    unit_store = options["unit_store"]
+    if unit_store is not None:
+        unit_store.set(code, mode, blackened)
+
+
+def run_backend(code, mode):
+    """format the code with the selected backend"""
+    func = format_funcs[options["backend"]]
+
+    return func(code, mode, **options["backend_options"])
+
+
+def verify(code, blackened, mode):
+    """check that the formatted code is equivalent to the code and stable
+
+    Like ``black --safe``, this compares the ASTs and formats a second time.
+    """
+    black.assert_equivalent(code, blackened)
+    if options["backend"] == "black":
+        black.assert_stable(code, blackened, mode=mode)
+    elif run_backend(blackened, mode) != blackened:
+        raise AssertionError(
+            "INTERNAL ERROR: the backend produced different code on the second pass"
+        )
+
+
+def is_safe(code, blackened, mode):
+    try:
+        verify(code, blackened, mode)
+    except safety_errors:
+        return False
+
+    return True
+
+
+def run_black(code, mode):
+    """format the code with the backend and remember the result
+
+    Results are only remembered after they have been verified.
+    """
+    blackened = run_backend(code, mode)
+    if options["safe"]:
+        verify(code, blackened, mode)
+    remember(code, mode, blackened)
+
+    return blackened
+
+
+def format_str(code, mode):
+    """format the code with black, reusing previous results"""
+    blackened = lookup(code, mode)
+    if blackened is not None:
+        return blackened
+
+    return run_black(code, mode)
+
+
+@functools.lru_cache(maxsize=64)
+def effective_mode(mode, line_length):
+    """the mode with a different line length
+
+    The modes are shared between code units, so they must not be modified.
+    """
+    if mode.line_length == line_length:
+        return mode
+
+    return dataclasses.replace(mode, line_length=line_length)
+
+
+def prepare_unit(original_line_range, code_format, line_unit, mode=None):
+    """extract the code from a unit and determine the mode to format it with
+
+    Returns the extracted code, the mode, the line number of the first line of
+    code and the parameters needed to reformat the blackened code.
+    """
+    indentation_depth, parameters, code = extract_code(line_unit, code_format)
+
+    if mode is None:
+        mode = black.Mode()
+    current_mode = effective_mode(
+        mode,
+        mode.line_length - indentation_depth - parameters.pop("prompt_length", 0),
+    )
+
+    original_line_number, _ = original_line_range
+    original_line_number += parameters.pop("n_header_lines", 0)
+
+    return code, current_mode, original_line_number, (indentation_depth, parameters)
+
+
+@functools.lru_cache(maxsize=4096)
+def features_used(code):
+    """the features of python used by the code
+
+    Returns an empty set if the code can't be parsed.
+    """
+    try:
+        return frozenset(black.get_features_used(black.lib2to3_parse(code)))
+    except black.InvalidInput:
+        return frozenset()
+
+
+def infer_target_versions(codes):
+    """infer the target versions from the code of several code units
+
+    Code units that can't be parsed are ignored.
+    """
+    features = frozenset().union(*(features_used(code) for code in codes))
+
+    return {
+        version
+        for version in black.TargetVersion
+        if features <= black.VERSION_TO_FEATURES[version]
+    }
+
+
+def prepare_units(units, mode=None):
+    """prepare the code units of a file
+
+    ``units`` are tuples of the span, the format and the unit. If enabled and
+    the target versions are not given explicitly, they are inferred once from
+    all code units instead of separately for each code unit. If that doesn't
+    rule out any version, the target versions are left empty.
+    """
+    prepared = [
+        (span, code_format, prepare_unit(span.line_range, code_format, line_unit, mode))
+        for span, code_format, line_unit in units
+    ]
+
+    if mode is None:
+        mode = black.Mode()
+    if mode.target_versions or not options["infer_target_versions"] or not prepared:
+        return prepared
+
+    target_versions = infer_target_versions(
+        [code for _, _, (code, _, _, _) in prepared]
+    )
+    if not target_versions or target_versions == set(black.TargetVersion):
+        # keep black's own inference and error messages
+        return prepared
+
+    file_mode = dataclasses.replace(mode, target_versions=target_versions)
+
+    return [
+        (
+            span,
+            code_format,
+            (
+                code,
+                effective_mode(file_mode, current_mode.line_length),
+                line_number,
+                parameters,
+            ),
+        )
+        for span, code_format, (code, current_mode, line_number, parameters) in prepared
+    ]
+
+
+def format_code(code, mode, original_line_number, formatter=format_str):
+    """run black on the extracted code
+
+    Line numbers in error messages are translated to the original file.
+    """
+    try:
+        return formatter(code, mode).rstrip()
+    except TokenError as e:
+        message, (apparent_line_number, column) = e.args
+
+        lineno = original_line_number + (apparent_line_number - 1)
+        faulty_line = code.split("\n")[(apparent_line_number - 1) - 1]
+
+        raise black.InvalidInput(
+            f"Cannot parse: {lineno}:{column}: {message}: {faulty_line}"
+        )
+    except black.InvalidInput as e:
+        message, apparent_line_number, column, faulty_line = parse_message(str(e))
+
+        lineno = original_line_number + (apparent_line_number - 1)
+        raise black.InvalidInput(f"{message}: {lineno}:{column}: {faulty_line}")
+    except IndentationError as e:
+        lineno = original_line_number + (e.lineno - 1)
+        line = e.text.rstrip()
+
+        # TODO: try to find the actual line, this exception is
+        # only raised when the indentation causes the code to
+        # become ambiguous
+        raise black.InvalidInput(f"Invalid indentation: {lineno}: {line}")
+    except safety_errors as e:
+        if not options["safe"]:
+            raise
+
+        message = str(e).split("\n")[0].split(".  ")[0]
+        raise UnsafeFormattingError(
+            f"Cannot verify code unit: {original_line_number}: {message}"
+        ) from e
+
+
+def can_batch(code_format, code, mode):
+    """check whether the code can be formatted together with other code units
+
+    The result has to be the same as when formatting the code on its own, so
+    code with comments, leading strings (which ``black`` treats as docstrings)
+    or ``__future__`` imports is excluded. Without explicit target versions
+    ``black`` infers them from the code, so these are required, too.
+    """
+    return (
+        code_format in batched_formats
+        and bool(mode.target_versions)
+        and bool(code.strip())
+        and "#" not in code
+        and "__future__" not in code
+        and leading_string_re.match(code) is None
+    )
+
+
+def format_batch(codes, mode):
+    """format code units with a single statement each in a single call to black
+
+    Returns the formatted code units, or ``None`` if they can't be formatted
+    together.
+    """
+    joined = "\n".join(codes)
+
+    # every code unit has to be exactly one statement
+    expected_starts = list(
+        itertools.accumulate((code.count("\n") + 1 for code in codes[:-1]), initial=0)
+    )
+    try:
+        _, statement_starts = scan_code_unit(joined, None)
+        if statement_starts != expected_starts:
+            return None
+
+        blackened = run_backend(joined, mode)
+        _, statement_starts = scan_code_unit(blackened, None)
+    except (TokenError, tokenize.TokenError, SyntaxError, black.InvalidInput):
+        return None
+
+    if len(statement_starts) != len(codes):
+        return None
+
+    lines = blackened.split("\n")
+    slices = more_itertools.pairwise(statement_starts + [len(lines)])
+    # `black` separates the statements by blank lines
+    return ["\n".join(lines[start:stop]).rstrip() + "\n" for start, stop in slices]
+
+
+def format_many(codes, mode, original_line_numbers, batch_func):
+    """format code units with the same mode using a single call to the backend
+
+    Errors are raised for the first code unit that failed, in order.
+    """
+    results = {code: None for code in codes}
+    for code in results:
+        results[code] = lookup(code, mode)
+
+    missing = [code for code, result in results.items() if result is None]
+    if missing:
+        statistics["backend batches"] += 1
+        formatted = batch_func(missing, mode, **options["backend_options"])
+        for code, result in zip(missing, formatted):
+            if not isinstance(result, Exception):
+                try:
+                    if options["safe"]:
+                        verify(code, result, mode)
+                except safety_errors as e:
+                    result = e
+                else:
+                    remember(code, mode, result)
+
+            results[code] = result
+
+    def fetch(code, mode):
+        result = results[code]
+        if isinstance(result, Exception):
+            raise result
+
+        return result
+
+    return [
+        format_code(code, mode, line_number, formatter=fetch)
+        for code, line_number in zip(codes, original_line_numbers)
+    ]
+
+
+def format_codes(codes, mode, original_line_numbers):
+    """format several code units with the same mode
+
+    Backends that can format many code units at once get all of them in a
+    single call. Otherwise, if enabled, code units that were not formatted
+    before are formatted together. Falls back to formatting each code unit on
+    its own if that is not possible.
+    """
+    batch_func = batch_funcs.get(options["backend"])
+    if batch_func is not None and len(codes) > 1:
+        return format_many(codes, mode, original_line_numbers, batch_func)
+    elif options["batch_units"]:
+        format_together = format_joined
+    elif options["batch_prompts"]:
+        format_together = format_batch
+    else:
+        format_together = None
+
+    if format_together is None or len(codes) < 2:
+        return [
+            format_code(code, mode, line_number)
+            for code, line_number in zip(codes, original_line_numbers)
+        ]
+
+    results = {code: None for code in codes}
+    for code in results:
+        results[code] = lookup(code, mode)
+
+    missing = [code for code, result in results.items() if result is None]
+    batched = format_together(missing, mode) if len(missing) > 1 else None
+    if batched is not None and options["safe"]:
+        # formatting separately reports the error of the unsafe unit
+        if not all(
+            is_safe(code, blackened, mode) for code, blackened in zip(missing, batched)
+        ):
+            batched = None
+
+    if batched is not None:
+        statistics["batched units"] += len(missing)
+        for code, blackened in zip(missing, batched):
+            remember(code, mode, blackened)
+            results[code] = blackened
+
+    return [
+        (
+            format_code(code, mode, line_number, formatter=run_black)
+            if results[code] is None
+            else results[code].rstrip()
+        )
+        for code, line_number in zip(codes, original_line_numbers)
+    ]
+
+
+def can_join(code, mode):
+    """check whether the code can be joined with other code units
+
+    Like ``can_batch``, except that comments other than ``fmt:`` directives
+    are allowed and the format doesn't matter.
+    """
+    return (
+        bool(mode.target_versions)
+        and bool(code.strip())
+        and "fmt:" not in code
+        and "__future__" not in code
+        and sentinel_prefix not in code
+        and leading_string_re.match(code.lstrip()) is None
+    )
+
+
+def separated_by_sentinels(code, sentinels):
+    """check that the sentinels are statements at the top level of the code
+
+    Code units that are incomplete on their own (like unclosed brackets or
+    strings) would otherwise swallow the sentinels.
+    """
+    expected = iter(sentinels)
+    skipped = (tokenize.NL, tokenize.COMMENT)
+
+    depth = 0
+    previous = tokenize.NEWLINE
+    after_sentinel = False
+    try:
+        for token in tokenize.generate_tokens(io.StringIO(code).readline):
+            if token.type in skipped:
+                continue
+            elif after_sentinel and token.type != tokenize.NEWLINE:
+                return False
+
+            after_sentinel = False
+            if token.type == tokenize.OP and token.string in "([{":
+                depth += 1
+            elif token.type == tokenize.OP and token.string in ")]}":
+                depth -= 1
+            elif token.type == tokenize.NAME and token.string.startswith(
+                sentinel_prefix
+            ):
+                if (
+                    depth != 0
+                    or token.start[1] != 0
+                    or previous not in (tokenize.NEWLINE, tokenize.DEDENT)
+                    or token.string != next(expected, None)
+                ):
+                    return False
+                after_sentinel = True
+
+            previous = token.type
+    except (tokenize.TokenError, SyntaxError):
+        return False
+
+    return next(expected, None) is None
+
+
+def format_joined(codes, mode):
+    """format code units with the same mode in a single call to black
+
+    The code units are joined into a single module, separated by sentinel
+    statements. Returns the formatted code units, or ``None`` if they can't
+    be formatted together.
+    """
+    sentinels = [f"{sentinel_prefix}{index}__" for index in range(len(codes) - 1)]
+    joined = "\n".join(more_itertools.interleave_longest(codes, sentinels))
+    if not separated_by_sentinels(joined, sentinels):
+        return None
+
+    try:
+        blackened = run_backend(joined, mode)
+    except (TokenError, tokenize.TokenError, SyntaxError, black.InvalidInput):
+        return None
+
+    lines = blackened.split("\n")
+    positions = [
+        index for index, line in enumerate(lines) if line.startswith(sentinel_prefix)
+    ]
+    if [lines[position] for position in positions] != sentinels:
+        return None
+
+    # `black` separates the code units by blank lines
+    slices = more_itertools.pairwise([-1] + positions + [len(lines)])
+    return [
+        "\n".join(lines[start + 1 : stop]).strip("\n") + "\n" for start, stop in slices
+    ]
+
+
+def consecutive_prompts(prepared):
+    """group consecutive code units that can be formatted together
+
+    ``prepared`` are tuples of the span, the format and the prepared unit
+    (see ``prepare_unit``). Code units are consecutive if there are no other
+    lines between them.
+    """
+    batch = []
+    for item in prepared:
+        span, code_format, (code, mode, _, _) = item
+        if not can_batch(code_format, code, mode):
+            if batch:
+                yield batch
+                batch = []
+            yield [item]
+            continue
+
+        if batch:
+            previous_span, previous_format, (_, previous_mode, _, _) = batch[-1]
+            if (
+                previous_span.line_range[1] != span.line_range[0]
+                or previous_format != code_format
+                or previous_mode != mode
+            ):
+                yield batch
+                batch = []
+
+        batch.append(item)
+
+    if batch:
+        yield batch
+
+
+def group_by_mode(prepared):
+    """group the code units of a file by their mode"""
+    groups = {}
+    for item in prepared:
+        _, _, (_, mode, _, _) = item
+        groups.setdefault(mode, []).append(item)
+
+    return list(groups.values())
+
+
+def join_units(prepared):
+    """group the code units that can be joined by their mode
+
+    Groups have at most ``max_joined_units`` code units, and code units that
+    can't be joined are on their own.
+    """
+    groups = {}
+    for item in prepared:
+        _, _, (code, mode, _, _) = item
+        if not can_join(code, mode):
+            yield [item]
+            continue
+
+        group = groups.setdefault(mode, [])
+        group.append(item)
+        if len(group) >= max_joined_units:
+            yield groups.pop(mode)
+
+    yield from groups.values()
+
+
+def unit_batches(prepared):
+    """group the prepared code units into the batches formatted together
+
+    Backends that can format many code units at once get all units of a file
+    with the same mode. The batches are not necessarily in order.
+    """
+    if options["backend"] in batch_funcs:
+        return group_by_mode(prepared)
+    elif options["batch_units"]:
+        return join_units(prepared)
+    elif options["batch_prompts"]:
+        return consecutive_prompts(prepared)
+    else:
+        return ([item] for item in prepared)
+
+
+def blacken_unit(original_line_range, code_format, line_unit, mode=None):
+    code, current_mode, original_line_number, (indentation_depth, parameters) = (
+        prepare_unit(original_line_range, code_format, line_unit, mode=mode)
+    )
+
+    blackened = format_code(code, current_mode, original_line_number)
+
+    return reformat_code(blackened, code_format, indentation_depth, **parameters)
+
+
 def blacken(lines, mode=None):
     for original_line_range, code_format, line_unit in lines:
         if code_format == "none":
             yield line_unit
             continue
 
-        indentation_depth, parameters, code = extract_code(line_unit, code_format)
+        yield blacken_unit(original_line_range, code_format, line_unit, mode=mode)
 
-        current_mode = black.FileMode() if mode is None else copy.copy(mode)
-        current_mode.line_length -= indentation_depth + parameters.pop(
-            "prompt_length", 0
-        )
 
-        original_line_number, _ = original_line_range
-        original_line_number += parameters.pop("n_header_lines", 0)
+def blacken_spans(content, lines, mode=None, first_line_number=1):
+    """format the code units of the content
 
-        try:
-            blackened = black.format_str(code, mode=current_mode).rstrip()
-        except TokenError as e:
-            message, (apparent_line_number, column) = e.args
+    Yields the span of each code unit together with the reformatted code, to
+    be spliced into the content.
+    """
+    spans = unit_spans(content, lines, first_line_number=first_line_number)
+    prepared = prepare_units(spans, mode=mode)
 
-            lineno = original_line_number + (apparent_line_number - 1)
-            faulty_line = code.split("\n")[(apparent_line_number - 1) - 1]
+    def format_batch_(batch):
+        _, _, (_, current_mode, _, _) = batch[0]
+        blackened = format_codes(
+            [code for _, _, (code, _, _, _) in batch],
+            current_mode,
+            [line_number for _, _, (_, _, line_number, _) in batch],
+        )
 
-            raise black.InvalidInput(
-                f"Cannot parse: {lineno}:{column}: {message}: {faulty_line}"
+        replacements = []
+        for (span, code_format, (_, _, _, parameters)), code in zip(batch, blackened):
+            indentation_depth, parameters = parameters
+            replacements.append(
+                (
+                    span,
+                    reformat_code(code, code_format, indentation_depth, **parameters),
+                )
             )
-        except black.InvalidInput as e:
-            message, apparent_line_number, column, faulty_line = parse_message(str(e))
-
-            lineno = original_line_number + (apparent_line_number - 1)
-            raise black.InvalidInput(f"{message}: {lineno}:{column}: {faulty_line}")
-        except IndentationError as e:
-            lineno = original_line_number + (e.lineno - 1)
-            line = e.text.rstrip()
-
-            # TODO: try to find the actual line, this exception is
-            # only raised when the indentation causes the code to
-            # become ambiguous
-            raise black.InvalidInput(f"Invalid indentation: {lineno}: {line}")
-
-        reformatted = reformat_code(
-            blackened, code_format, indentation_depth, **parameters
-        )
 
-        yield reformatted
+        return replacements
+
+    # the batches are not in order, so the error of the first code unit that
+    # can't be formatted has to be found
+    replacements = []
+    failures = []
+    for batch in unit_batches(prepared):
+        try:
+            replacements.extend(format_batch_(batch))
+        except black.InvalidInput:
+            for item in batch:
+                span, _, _ = item
+                try:
+                    replacements.extend(format_batch_([item]))
+                except black.InvalidInput as e:
+                    failures.append((span.start, e))
+
+    if failures:
+        _, error = min(failures, key=lambda failure: failure[0])
+        raise error
+
+    yield from sorted(replacements, key=lambda item: item[0].start)
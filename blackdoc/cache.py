@@ -0,0 +1,372 @@
+"""persistent caching of formatting results
+
+Inspired by the cache of ``black``.
+"""
+
+import hashlib
+import os
+import pickle
+import tempfile
+import time
+from pathlib import Path
+
+import black
+from platformdirs import user_cache_dir
+
+try:
+    import sqlite3
+except ImportError:  # pragma: no cover
+    # python can be built without sqlite
+    sqlite3 = None
+
+
+def get_cache_dir(cache_dir=None):
+    """determine the cache directory
+
+    In order of precedence, this is the directory passed explicitly, the value
+    of the ``BLACKDOC_CACHE_DIR`` environment variable, or the user cache
+    directory.
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get("BLACKDOC_CACHE_DIR")
+    if cache_dir is None:
+        cache_dir = user_cache_dir("blackdoc")
+
+    return Path(cache_dir).expanduser()
+
+
+def cache_key(mode, **options):
+    """compute a key for everything that influences the formatting result"""
+    from blackdoc import __version__
+    from blackdoc.formats import detection_funcs, detection_patterns
+
+    parts = [
+        __version__,
+        black.__version__,
+        mode.get_cache_key(),
+        ",".join(sorted(detection_funcs)),
+        ",".join(
+            f"{name}={pattern}" for name, pattern in sorted(detection_patterns.items())
+        ),
+        *(f"{name}={value!r}" for name, value in sorted(options.items())),
+    ]
+
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+
+def hash_digest(path):
+    with open(path, mode="rb") as f:
+        data = f.read()
+
+    return hashlib.sha256(data).hexdigest()
+
+
+def get_file_data(path):
+    stat = path.stat()
+    return stat.st_mtime, stat.st_size, hash_digest(path)
+
+
+class Cache:
+    """files known to be formatted for a specific cache key
+
+    The file data consists of the modification time, the size and the hash
+    of the content.
+    """
+
+    def __init__(self, cache_file, file_data=None):
+        self.cache_file = cache_file
+        self.file_data = file_data if file_data is not None else {}
+
+    @classmethod
+    def read(cls, key, cache_dir=None):
+        cache_file = get_cache_dir(cache_dir) / f"cache.{key}.pickle"
+        if not cache_file.is_file():
+            return cls(cache_file)
+
+        try:
+            with open(cache_file, mode="rb") as f:
+                file_data = pickle.load(f)
+        except (pickle.UnpicklingError, ValueError, EOFError, OSError):
+            return cls(cache_file)
+
+        return cls(cache_file, file_data)
+
+    def is_changed(self, path):
+        """check whether the path was modified since it was cached"""
+        resolved = path.resolve()
+        data = self.file_data.get(str(resolved))
+        if data is None:
+            return True
+
+        mtime, size, digest = data
+        stat = resolved.stat()
+        if stat.st_size != size:
+            return True
+        if stat.st_mtime != mtime:
+            return hash_digest(resolved) != digest
+
+        return False
+
+    def filtered_cached(self, sources):
+        """split the sources into changed and cached sources"""
+        changed = set()
+        cached = set()
+        for source in sources:
+            if str(source) == "-" or self.is_changed(source):
+                changed.add(source)
+            else:
+                cached.add(source)
+
+        return changed, cached
+
+    def write(self, sources):
+        """record the sources as formatted"""
+        self.file_data.update(
+            {
+                str(source.resolve()): get_file_data(source.resolve())
+                for source in sources
+                if str(source) != "-"
+            }
+        )
+
+        try:
+            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                dir=self.cache_file.parent, delete=False
+            ) as f:
+                pickle.dump(self.file_data, f, protocol=4)
+            os.replace(f.name, self.cache_file)
+        except OSError:
+            # failing to write the cache is not fatal
+            pass
+
+
+def unit_key(code, mode):
+    """compute the key of a code unit in the unit store"""
+    parts = [black.__version__, mode.get_cache_key(), code]
+
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+
+class Database:
+    """base class of the stores kept in the sqlite database of the cache directory
+
+    The connection is opened on first use and again in forked processes.
+    Subclasses create their tables in ``setup``.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        self._connection = None
+        self._pid = None
+
+    @classmethod
+    def open(cls, cache_dir=None, **kwargs):
+        """open the store in the cache directory
+
+        Returns ``None`` if ``sqlite3`` is not available.
+        """
+        if sqlite3 is None:
+            return None
+
+        return cls(get_cache_dir(cache_dir) / "units.sqlite", **kwargs)
+
+    def setup(self, connection):
+        pass
+
+    @property
+    def connection(self):
+        # connections can't be shared with forked processes
+        if self._connection is None or self._pid != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.setup(connection)
+
+            self._connection = connection
+            self._pid = os.getpid()
+
+        return self._connection
+
+    def __getstate__(self):
+        # only the arguments of the constructor
+        return {
+            name: value
+            for name, value in vars(self).items()
+            if not name.startswith("_")
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def close(self):
+        if self._connection is not None and self._pid == os.getpid():
+            self._connection.close()
+
+        self._connection = None
+
+
+class UnitStore(Database):
+    """persistent mapping of code units to their formatted version
+
+    The store is a single sqlite database shared between runs, files and
+    processes. Once it contains more than ``max_entries`` units, the least
+    recently used units are evicted.
+    """
+
+    def __init__(self, path, max_entries=100_000):
+        super().__init__(path)
+        self.max_entries = max_entries
+
+        self._n_writes = 0
+
+    def setup(self, connection):
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS units"
+            " (key TEXT PRIMARY KEY, result TEXT NOT NULL, used REAL NOT NULL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS units_used ON units (used)")
+
+    def get(self, code, mode):
+        """look up the formatted version of the code
+
+        Returns ``None`` if the unit is unknown or the store can't be read.
+        """
+        key = unit_key(code, mode)
+
+        try:
+            row = self.connection.execute(
+                "SELECT result FROM units WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            self.connection.execute(
+                "UPDATE units SET used = ? WHERE key = ?", (time.time(), key)
+            )
+        except (sqlite3.Error, OSError):
+            return None
+
+        (result,) = row
+
+        return result
+
+    def set(self, code, mode, result):
+        key = unit_key(code, mode)
+
+        try:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO units (key, result, used) VALUES (?, ?, ?)",
+                (key, result, time.time()),
+            )
+
+            self._n_writes += 1
+            if self._n_writes % 256 == 0:
+                self.evict()
+        except (sqlite3.Error, OSError):
+            # failing to write to the store is not fatal
+            pass
+
+    def evict(self):
+        """remove the least recently used units"""
+        (n_entries,) = self.connection.execute("SELECT count(*) FROM units").fetchone()
+        if n_entries <= self.max_entries:
+            return
+
+        self.connection.execute(
+            "DELETE FROM units WHERE key IN"
+            " (SELECT key FROM units ORDER BY used LIMIT ?)",
+            (n_entries - self.max_entries,),
+        )
+
+    def close(self):
+        if self._connection is not None and self._pid == os.getpid():
+            try:
+                self.evict()
+            except sqlite3.Error:
+                pass
+
+        super().close()
+
+
+def stable_result(code):
+    """the output of ``black`` for code that is already formatted"""
+    return code if code.endswith("\n") else code + "\n"
+
+
+class StableUnits(Database):
+    """persistent set of code units that ``black`` does not change
+
+    Only fingerprints of the code and the mode are stored, in the same
+    database as the unit store. The set is loaded into memory on first use,
+    and cleared whenever the version of ``black`` changes.
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+
+        self._fingerprints = None
+
+    @staticmethod
+    def fingerprint(code, mode):
+        parts = [mode.get_cache_key(), code]
+
+        return hashlib.blake2b("\n".join(parts).encode(), digest_size=16).digest()
+
+    def setup(self, connection):
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS stable (fingerprint BLOB PRIMARY KEY)"
+        )
+
+        row = connection.execute(
+            "SELECT value FROM meta WHERE key = 'black_version'"
+        ).fetchone()
+        if row is None or row[0] != black.__version__:
+            # a different version of black may format differently
+            connection.execute("DELETE FROM stable")
+            connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('black_version', ?)",
+                (black.__version__,),
+            )
+
+        self._fingerprints = None
+
+    @property
+    def fingerprints(self):
+        if self._fingerprints is None or self._pid != os.getpid():
+            try:
+                rows = self.connection.execute("SELECT fingerprint FROM stable")
+                self._fingerprints = {fingerprint for (fingerprint,) in rows}
+            except (sqlite3.Error, OSError):
+                self._fingerprints = set()
+
+        return self._fingerprints
+
+    def __contains__(self, item):
+        code, mode = item
+
+        return self.fingerprint(code, mode) in self.fingerprints
+
+    def add(self, code, mode):
+        fingerprint = self.fingerprint(code, mode)
+        if fingerprint in self.fingerprints:
+            return
+
+        self.fingerprints.add(fingerprint)
+        try:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO stable (fingerprint) VALUES (?)", (fingerprint,)
+            )
+        except (sqlite3.Error, OSError):
+            # failing to write to the set is not fatal
+            pass
+
+    def close(self):
+        super().close()
+        self._fingerprints = None
@@ -1,25 +1,367 @@
+import array
+import bisect
+import functools
+import io
+import re
+import tokenize
+
 import more_itertools
 
-from blackdoc.formats import detection_funcs
+from blackdoc.blacken import options
+from blackdoc.formats import detection_funcs, formats_for, leading_characters
+from blackdoc.formats.cursor import LineCursor
 
+python_file_re = re.compile(r"\.pyi?$")
+# the opening fence of markdown code blocks and myst directives
+fence_re = re.compile(r"^[ ]{0,3}(?P<fence>`{3,}|:{3,})")
+string_token_types = {
+    getattr(tokenize, name)
+    for name in ("STRING", "FSTRING_MIDDLE", "TSTRING_MIDDLE")
+    if hasattr(tokenize, name)
+}
 
-def detect_format(lines):
-    lines = more_itertools.peekable(lines)
-    while lines:
-        maybe_detected = (
-            (name, func(lines))
-            for name, func in detection_funcs.items()
-            if name != "none"
+
+@functools.lru_cache(maxsize=8)
+def build_dispatcher(funcs):
+    """map the first non-whitespace character of a line to the candidate formats
+
+    Formats that don't declare their leading characters are candidates for
+    every line.
+    """
+    funcs = tuple((name, func) for name, func in funcs if name != "none")
+    unrestricted = tuple(
+        (name, func) for name, func in funcs if name not in leading_characters
+    )
+    characters = {
+        char
+        for name, _ in funcs
+        if name in leading_characters
+        for char in leading_characters[name]
+    }
+    table = {
+        char: tuple(
+            (name, func)
+            for name, func in funcs
+            if name not in leading_characters or char in leading_characters[name]
         )
-        detected = {name: value for name, value in maybe_detected if value is not None}
+        for char in characters
+    }
+
+    return table, unrestricted
+
+
+def enabled_detection_funcs(path=None):
+    funcs = tuple(detection_funcs.items())
+    if path is None:
+        return funcs
+
+    names = formats_for(path)
+    return tuple((name, func) for name, func in funcs if name in names)
+
+
+@functools.lru_cache(maxsize=8)
+def candidate_pattern(funcs):
+    """combine the leading characters of the formats into a single pattern
+
+    Returns ``None`` if any of the formats does not declare its leading
+    characters.
+    """
+    table, unrestricted = build_dispatcher(funcs)
+    if unrestricted or not table:
+        return None
+
+    characters = "".join(sorted(table))
+    return re.compile(rf"^[^\S\n]*[{re.escape(characters)}]", flags=re.MULTILINE)
+
+
+def candidate_lines(content, path=None, first_line_number=1):
+    """find the lines that may start a code unit
+
+    Returns the sorted line numbers, or ``None`` if the candidates can't be
+    determined.
+    """
+    pattern = candidate_pattern(enabled_detection_funcs(path))
+    if pattern is None:
+        return None
+
+    line_numbers = array.array("q")
+    line_number = first_line_number
+    offset = 0
+    for match in pattern.finditer(content):
+        start = match.start()
+        line_number += content.count("\n", offset, start)
+        offset = start
+
+        line_numbers.append(line_number)
+
+    return line_numbers
+
+
+def detect_format(lines, path=None, candidates=None):
+    """classify the lines into code units
+
+    ``lines`` is either a ``LineCursor`` or an iterable of line numbers and
+    lines. Consecutive lines that don't belong to any code unit are merged
+    into a single unit of format ``"none"``.
+
+    If the path of the file is given, only the formats that can appear in
+    the file are used. If given, ``candidates`` are the sorted numbers of the
+    lines that may start a code unit (see ``candidate_lines``), and all other
+    lines are skipped without calling the detection functions.
+    """
+    funcs = enabled_detection_funcs(path)
+    table, unrestricted = build_dispatcher(funcs)
+
+    if not isinstance(lines, LineCursor):
+        lines = LineCursor.from_numbered(lines)
+
+    # start of the current run of lines without code
+    run_start = None
+    while lines:
+        position = lines.mark()
+        if candidates is not None:
+            # jump to the next line that may start a code unit
+            index = bisect.bisect_left(candidates, lines.line_number)
+            candidate = (
+                candidates[index] - lines.first_line_number
+                if index < len(candidates)
+                else len(lines.lines)
+            )
+            if candidate > position:
+                if run_start is None:
+                    run_start = position
+                lines.reset(min(candidate, len(lines.lines)))
+                continue
+
+        line = lines.peek()
+        candidate_funcs = table.get(line.lstrip()[:1], unrestricted)
+        if not candidate_funcs:
+            # no format can start on this line
+            if run_start is None:
+                run_start = position
+            lines.advance()
+            continue
+
+        detected = {}
+        for name, func in candidate_funcs:
+            lines.reset(position)
+            unit = func(lines)
+            if unit is not None:
+                detected[name] = unit, lines.mark()
 
         if not detected:
-            yield detection_funcs["none"](lines)
+            if run_start is None:
+                run_start = position
+            lines.reset(position + 1)
+            continue
         elif len(detected) > 1:
             formatted_match_names = ", ".join(sorted(detected.keys()))
             raise RuntimeError(
                 "cannot detect code format for line:"
-                f" it is claimed by {formatted_match_names}: {lines.peek()}"
+                f" it is claimed by {formatted_match_names}: {line}"
+            )
+
+        unit, end = more_itertools.one(detected.values())
+        _, code_format, _ = unit
+        if code_format == "none":
+            if run_start is None:
+                run_start = position
+            lines.reset(end)
+            continue
+
+        if run_start is not None:
+            yield lines.unit("none", run_start, position)
+            run_start = None
+
+        lines.reset(end)
+        yield unit
+
+    if run_start is not None:
+        yield lines.unit("none", run_start)
+
+
+def string_line_ranges(content):
+    """find the lines containing string literals in python code
+
+    Returns the ranges of line numbers, or ``None`` if the code can't be
+    tokenized.
+    """
+    ranges = []
+    try:
+        for token in tokenize.generate_tokens(io.StringIO(content).readline):
+            if token.type not in string_token_types:
+                continue
+
+            (first, _), (last, _) = token.start, token.end
+            if ranges and first <= ranges[-1][1]:
+                start, stop = ranges[-1]
+                ranges[-1] = (start, max(stop, last + 1))
+            else:
+                ranges.append((first, last + 1))
+    except (tokenize.TokenError, SyntaxError):
+        return None
+
+    return ranges
+
+
+def merge_unformatted(units):
+    """merge consecutive units of format ``"none"``"""
+    pending = []
+    for unit in units:
+        _, code_format, _ = unit
+        if code_format == "none":
+            pending.append(unit)
+            continue
+
+        if pending:
+            yield coalesce(pending)
+            pending = []
+
+        yield unit
+
+    if pending:
+        yield coalesce(pending)
+
+
+def coalesce(units):
+    (start, _), _, _ = units[0]
+    (_, stop), _, _ = units[-1]
+
+    return (start, stop), "none", "\n".join(text for _, _, text in units)
+
+
+def detect_format_in_ranges(
+    lines, ranges, path=None, candidates=None, first_line_number=1
+):
+    """classify the lines within the ranges
+
+    All other lines are passed through as units of format ``"none"``.
+    """
+    return merge_unformatted(
+        _detect_format_in_ranges(
+            lines,
+            ranges,
+            path=path,
+            candidates=candidates,
+            first_line_number=first_line_number,
+        )
+    )
+
+
+def _detect_format_in_ranges(
+    lines, ranges, path=None, candidates=None, first_line_number=1
+):
+    def index(line_number):
+        return line_number - first_line_number
+
+    line_number = first_line_number
+    end = first_line_number + len(lines)
+    for start, stop in ranges:
+        if start > line_number:
+            yield (line_number, start), "none", "\n".join(
+                lines[index(line_number) : index(start)]
             )
+
+        cursor = LineCursor(lines[index(start) : index(stop)], first_line_number=start)
+        yield from detect_format(cursor, path=path, candidates=candidates)
+
+        line_number = stop
+
+    if line_number < end:
+        yield (line_number, end), "none", "\n".join(lines[index(line_number) :])
+
+
+def classify(content, path=None, first_line_number=1):
+    """classify the content of a file
+
+    If enabled, only the string literals of python files are searched for
+    code units.
+
+    ``first_line_number`` is the line number of the first line of the
+    content, in case it is only a part of the file.
+    """
+    lines = content.split("\n")
+    candidates = candidate_lines(
+        content, path=path, first_line_number=first_line_number
+    )
+    labeled = detect_format(
+        LineCursor(lines, first_line_number),
+        path=path,
+        candidates=candidates,
+    )
+
+    if (
+        not options["strings_only"]
+        or path is None
+        or not python_file_re.search(str(path))
+    ):
+        return labeled
+
+    # tokenizing is much slower than the detection, so only do it for files
+    # that contain code units
+    labeled = tuple(labeled)
+    if all(code_format == "none" for _, code_format, _ in labeled):
+        return labeled
+
+    ranges = string_line_ranges(content)
+    if ranges is None:
+        return labeled
+
+    offset = first_line_number - 1
+    ranges = [(start + offset, stop + offset) for start, stop in ranges]
+
+    return detect_format_in_ranges(
+        lines,
+        ranges,
+        path=path,
+        candidates=candidates,
+        first_line_number=first_line_number,
+    )
+
+
+def split_points(lines):
+    """find the lines where the content can be split without splitting a code unit
+
+    These are lines without indentation that follow a blank line and are
+    outside of fenced blocks. Lines starting with ``@`` are excluded since
+    they may be decorators belonging to the preceding directive.
+
+    This relies on the way the built-in formats detect code units.
+    """
+    fence = None
+    previous_blank = False
+    for index, line in enumerate(lines):
+        stripped = line.strip()
+        if fence is not None:
+            if stripped.startswith(fence) and not stripped.strip(fence[0]):
+                fence = None
         else:
-            yield more_itertools.one(detected.values())
+            if previous_blank and stripped and line[0] == stripped[0] != "@":
+                yield index
+
+            match = fence_re.match(line)
+            if match is not None:
+                fence = match.group("fence")
+
+        previous_blank = not stripped
+
+
+def split_lines(lines, chunk_size):
+    """split the lines into chunks of at least ``chunk_size`` lines
+
+    The chunks are split at the lines returned by ``split_points`` and
+    returned as pairs of indices.
+    """
+    start = 0
+    # don't create a small chunk at the end
+    last = len(lines) - chunk_size
+    for point in split_points(lines):
+        if point > last:
+            break
+        elif point - start < chunk_size:
+            continue
+
+        yield start, point
+        start = point
+
+    yield start, len(lines)
@@ -0,0 +1,507 @@
+import collections
+import concurrent.futures
+
+import black
+
+from blackdoc import formats
+from blackdoc.blacken import (
+    UnitCache,
+    blacken_spans,
+    drain_statistics,
+    format_code,
+    format_codes,
+    options,
+    prepare_units,
+    statistics,
+    unit_batches,
+)
+from blackdoc.classification import classify, python_file_re, split_lines
+from blackdoc.console import err, out
+from blackdoc.files import read_file
+from blackdoc.spans import splice, unit_spans
+
+# the minimum number of lines of the chunks of a file, see `schedule_chunks`
+chunk_size = 5000
+
+
+def worker_state():
+    """collect the global state a worker process has to replicate"""
+    return {
+        "formats": tuple(formats.detection_funcs.keys()),
+        "options": dict(options),
+        "detection_patterns": dict(formats.detection_patterns),
+    }
+
+
+def initialize_worker(state):
+    """replay the state of the parent process in a worker process
+
+    With the ``spawn`` and ``forkserver`` start methods the worker does not
+    inherit modifications of the format registry, so these have to be
+    repeated.
+    """
+    disabled_formats = set(formats.detection_funcs.keys()) - set(state["formats"])
+    if disabled_formats:
+        formats.disable(disabled_formats)
+
+    options.update(state["options"])
+    formats.detection_patterns.update(state["detection_patterns"])
+
+
+def run_action(action, path, mode, kwargs):
+    """run the action on a single file and capture its output
+
+    The output is replayed by the parent process to keep the order of the
+    messages deterministic.
+    """
+    with err.capture() as captured_err, out.capture() as captured_out:
+        result = action(path, mode, **kwargs)
+
+    return result, captured_out.get(), captured_err.get(), drain_statistics()
+
+
+def run_unit(code, mode, original_line_number):
+    """format a single code unit"""
+    return format_code(code, mode, original_line_number), drain_statistics()
+
+
+def run_batch(codes, mode, original_line_numbers):
+    """format consecutive code units with the same mode"""
+    return format_codes(codes, mode, original_line_numbers), drain_statistics()
+
+
+def run_chunk(content, first_line_number, path, mode):
+    """classify and format a chunk of a file"""
+    labeled = classify(content, path=path, first_line_number=first_line_number)
+    replacements = blacken_spans(
+        content, labeled, mode=mode, first_line_number=first_line_number
+    )
+
+    return splice(content, replacements), drain_statistics()
+
+
+def replay(stdout, stderr):
+    # the actions print the status of a file before its diff
+    if stderr:
+        err.file.write(stderr)
+        err.file.flush()
+    if stdout:
+        out.file.write(stdout)
+        out.file.flush()
+
+
+def create_executor(workers):
+    try:
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=initialize_worker,
+            initargs=(worker_state(),),
+        )
+    except (ImportError, NotImplementedError, OSError):
+        # some platforms don't support process pools (e.g. missing
+        # `sem_open`); fall back to formatting in the main process
+        return None
+
+
+def process_sources(action, sources, mode, action_kwargs, workers=1):
+    """apply the action to all sources, potentially in parallel
+
+    The results and messages are in the same order as in the serial case.
+    """
+    sources = sorted(sources)
+
+    executor = create_executor(workers) if workers > 1 and len(sources) > 1 else None
+    if executor is None:
+        return {
+            source: action(source.resolve(), mode, **action_kwargs)
+            for source in sources
+        }
+
+    with executor:
+        futures = [
+            executor.submit(run_action, action, source.resolve(), mode, action_kwargs)
+            for source in sources
+        ]
+
+        results = {}
+        for source, future in zip(sources, futures):
+            result, stdout, stderr, drained = future.result()
+            replay(stdout, stderr)
+            statistics.update(drained)
+
+            results[source] = result
+
+    return results
+
+
+class SerialExecutor:
+    """executor that runs the submitted functions immediately"""
+
+    def submit(self, func, *args, **kwargs):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(func(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class PendingUnit:
+    """a code unit submitted to the executor"""
+
+    __slots__ = (
+        "span",
+        "future",
+        "owner",
+        "code",
+        "mode",
+        "line_number",
+        "code_format",
+        "parameters",
+        "index",
+    )
+
+    def __init__(
+        self,
+        span,
+        future,
+        owner,
+        code,
+        mode,
+        line_number,
+        code_format,
+        parameters,
+        index=None,
+    ):
+        self.span = span
+        self.future = future
+        # whether this unit submitted the future
+        self.owner = owner
+        self.code = code
+        self.mode = mode
+        self.line_number = line_number
+        self.code_format = code_format
+        self.parameters = parameters
+        # the position of the unit in the batch it was submitted with
+        self.index = index
+
+    def result(self):
+        """wait for the formatted code
+
+        Only the unit that submitted the future collects the statistics.
+        """
+        try:
+            blackened, drained = self.future.result()
+        except black.InvalidInput:
+            if self.owner and self.index is None:
+                raise
+
+            # the error may belong to another code unit of the batch or to the
+            # unit that was submitted, so format again to get the right one
+            blackened, drained = run_unit(self.code, self.mode, self.line_number)
+        else:
+            if self.index is not None:
+                blackened = blackened[self.index]
+
+        if self.owner:
+            statistics.update(drained)
+
+        return blackened
+
+
+class FileJob:
+    """the formatting state of a single file in the unit scheduler"""
+
+    def __init__(
+        self,
+        source,
+        path,
+        content=None,
+        encoding=None,
+        newline=None,
+        parts=(),
+        error=None,
+        unchanged=False,
+    ):
+        self.source = source
+        self.path = path
+        self.content = content
+        self.encoding = encoding
+        self.newline = newline
+        # pending units, ordered by their position in the content
+        self.parts = parts
+        self.error = error
+        # the file was skipped by the prescan
+        self.unchanged = unchanged
+
+    @property
+    def n_pending(self):
+        return len(self.parts)
+
+
+def submit_units(executor, source, mode, submitted):
+    """classify the file and submit the code units to the executor
+
+    Units that were already submitted reuse the existing future.
+    """
+    path = source.resolve()
+    try:
+        decoded = read_file(path, mode)
+        if decoded is None:
+            return FileJob(source, path, unchanged=True)
+
+        content, encoding, newline = decoded
+
+        labeled = classify(content, path=path)
+
+        prepared = prepare_units(unit_spans(content, labeled), mode=mode)
+        parts = []
+        for batch in unit_batches(prepared):
+            if len(batch) > 1:
+                parts.extend(submit_batch(executor, batch))
+                continue
+
+            ((span, code_format, prepared_unit),) = batch
+            code, current_mode, original_line_number, parameters = prepared_unit
+            key = (code, current_mode)
+            future = submitted.get(key)
+            owner = future is None
+            if owner:
+                future = executor.submit(
+                    run_unit, code, current_mode, original_line_number
+                )
+                submitted.set(key, future)
+            else:
+                statistics["unit cache hits"] += 1
+
+            parts.append(
+                PendingUnit(
+                    span,
+                    future,
+                    owner,
+                    code,
+                    current_mode,
+                    original_line_number,
+                    code_format,
+                    parameters,
+                )
+            )
+    except (black.InvalidInput, formats.InvalidFormatError) as e:
+        return FileJob(source, path, error=e)
+
+    parts.sort(key=lambda part: part.span.start)
+
+    return FileJob(source, path, content, encoding, newline, parts)
+
+
+def submit_batch(executor, batch):
+    """submit consecutive code units to be formatted together
+
+    Returns the pending units of the batch.
+    """
+    _, _, (_, mode, _, _) = batch[0]
+    future = executor.submit(
+        run_batch,
+        [code for _, _, (code, _, _, _) in batch],
+        mode,
+        [line_number for _, _, (_, _, line_number, _) in batch],
+    )
+
+    return [
+        PendingUnit(
+            span,
+            future,
+            index == 0,
+            code,
+            mode,
+            line_number,
+            code_format,
+            parameters,
+            index=index,
+        )
+        for index, (span, code_format, (code, _, line_number, parameters)) in enumerate(
+            batch
+        )
+    ]
+
+
+def collect_units(job):
+    """wait for the code units of the file and reassemble them in order"""
+
+    def reformat(part):
+        indentation_depth, parameters = part.parameters
+
+        return formats.reformat_code(
+            part.result(), part.code_format, indentation_depth, **parameters
+        )
+
+    return splice(job.content, ((part.span, reformat(part)) for part in job.parts))
+
+
+def submit_chunks(executor, source, mode):
+    """split the file into chunks and submit them to the executor
+
+    With ``strings_only``, python files are not split since the string
+    literals are found by tokenizing the whole file. Files are also not split
+    if the target versions are inferred from all code units of the file.
+    """
+    path = source.resolve()
+    try:
+        decoded = read_file(path, mode)
+    except (black.InvalidInput, formats.InvalidFormatError) as e:
+        return FileJob(source, path, error=e)
+
+    if decoded is None:
+        return FileJob(source, path, unchanged=True)
+
+    content, encoding, newline = decoded
+
+    lines = content.split("\n")
+    if options["infer_target_versions"] or (
+        options["strings_only"] and python_file_re.search(str(path))
+    ):
+        chunks = [(0, len(lines))]
+    else:
+        chunks = list(split_lines(lines, chunk_size))
+
+    if len(chunks) == 1:
+        parts = [executor.submit(run_chunk, content, 1, path, mode)]
+    else:
+        parts = [
+            executor.submit(
+                run_chunk, "\n".join(lines[start:stop]), start + 1, path, mode
+            )
+            for start, stop in chunks
+        ]
+
+    return FileJob(source, path, content, encoding, newline, parts)
+
+
+def collect_chunks(job):
+    """wait for the formatted chunks of the file and join them"""
+    formatted = []
+    for future in job.parts:
+        chunk, drained = future.result()
+        statistics.update(drained)
+
+        formatted.append(chunk)
+
+    return "\n".join(formatted)
+
+
+def schedule_jobs(
+    submit, collect, finish, report_error, sources, finish_kwargs, workers, max_pending
+):
+    """submit the work for each source and finish the sources in order
+
+    At most ``max_pending`` tasks are submitted before the results of the
+    oldest source are collected.
+    """
+
+    def finalize(job):
+        if job.unchanged:
+            return "unchanged"
+        elif job.error is not None:
+            return report_error(job.path, job.error)
+
+        try:
+            new_content = collect(job)
+        except (black.InvalidInput, formats.InvalidFormatError) as e:
+            return report_error(job.path, e)
+
+        return finish(
+            job.path,
+            job.content,
+            new_content,
+            job.encoding,
+            job.newline,
+            **finish_kwargs,
+        )
+
+    executor = create_executor(workers) if workers > 1 else None
+    if executor is None:
+        executor = SerialExecutor()
+
+    results = {}
+    with executor:
+        pending = collections.deque()
+        n_pending = 0
+        for source in sorted(sources):
+            job = submit(executor, source)
+            n_pending += job.n_pending
+            pending.append(job)
+
+            while n_pending > max_pending and len(pending) > 1:
+                job = pending.popleft()
+                n_pending -= job.n_pending
+
+                results[job.source] = finalize(job)
+
+        while pending:
+            job = pending.popleft()
+            results[job.source] = finalize(job)
+
+    return results
+
+
+def schedule_units(finish, report_error, sources, mode, finish_kwargs, workers=1):
+    """format the code units of all sources as independent tasks
+
+    Classification and extraction happen in the main process, only the calls
+    to ``black`` are distributed to the workers. This allows balancing the
+    load between a single large file and many small files.
+
+    ``finish`` is called with the path, the original and the new content, the
+    encoding and the newline style, while ``report_error`` is called with the
+    path and the exception.
+    """
+    submitted = UnitCache()
+
+    def submit(executor, source):
+        return submit_units(executor, source, mode, submitted)
+
+    return schedule_jobs(
+        submit,
+        collect_units,
+        finish,
+        report_error,
+        sources,
+        finish_kwargs,
+        workers=workers,
+        # limit the amount of submitted but not yet collected units
+        max_pending=256 * workers,
+    )
+
+
+def schedule_chunks(finish, report_error, sources, mode, finish_kwargs, workers=1):
+    """format chunks of the sources as independent tasks
+
+    Large files are split into chunks of at least ``chunk_size`` lines at
+    lines that can't be part of a code unit (see
+    ``blackdoc.classification.split_points``). The chunks are classified and
+    formatted by the workers, which allows distributing the classification of
+    a single large file.
+
+    The arguments are the same as for ``schedule_units``.
+    """
+
+    def submit(executor, source):
+        return submit_chunks(executor, source, mode)
+
+    return schedule_jobs(
+        submit,
+        collect_chunks,
+        finish,
+        report_error,
+        sources,
+        finish_kwargs,
+        workers=workers,
+        max_pending=4 * workers,
+    )
@@ -1,6 +1,8 @@
 from black import Report
 
+from blackdoc import formats
 from blackdoc.blackcompat import (
+    decode_bytes,
     find_project_root,
     gen_python_files,
     get_gitignore,
@@ -50,3 +52,19 @@ def collect_files(src, include, exclude, extend_exclude, force_exclude, quiet, v
             yield path
         else:
             err.print(f"invalid path: {path}", style="red")
+
+
+def read_file(path, mode):
+    """read and decode the file
+
+    Returns the decoded content, the encoding and the newline style, or
+    ``None`` if the raw content does not contain any of the markers of the
+    enabled formats (and thus cannot contain code units).
+    """
+    with open(path, mode="rb") as f:
+        data = f.read()
+
+    if not formats.may_contain_code(data):
+        return None
+
+    return decode_bytes(data, mode)
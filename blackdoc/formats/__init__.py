@@ -6,10 +6,15 @@ from blackdoc.formats import doctest, ipython, markdown, none, rst
 from blackdoc.formats.errors import InvalidFormatError  # noqa: F401
 from blackdoc.formats.register import (
     detection_funcs,  # noqa: F401
+    detection_patterns,  # noqa: F401
     disable,  # noqa: F401
     extraction_funcs,
     format_include_patterns,  # noqa: F401
+    formats_for,  # noqa: F401
     include_patterns,  # noqa: F401
+    leading_characters,  # noqa: F401
+    markers,  # noqa: F401
+    may_contain_code,  # noqa: F401
     reformatting_funcs,
     register_format,
 )
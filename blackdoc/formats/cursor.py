@@ -0,0 +1,152 @@
+import functools
+
+from blackdoc.formats.errors import InvalidFormatError
+
+_missing = object()
+
+
+class LineCursor:
+    """index-based cursor over the lines of a document
+
+    Instead of pushing back consumed lines, detection functions remember the
+    current position using ``mark`` and return to it using ``reset``.
+    """
+
+    __slots__ = ("lines", "first_line_number", "position", "cache")
+
+    def __init__(self, lines, first_line_number=1):
+        self.lines = lines
+        self.first_line_number = first_line_number
+        self.position = 0
+        # precomputed data about the lines, by format name
+        self.cache = {}
+
+    @classmethod
+    def from_numbered(cls, numbered):
+        """create a cursor from pairs of line numbers and lines
+
+        The line numbers have to be contiguous.
+        """
+        numbered = iter(numbered)
+
+        first = next(numbered, None)
+        if first is None:
+            return cls([])
+
+        first_line_number, line = first
+        lines = [line]
+        for expected, (line_number, line) in enumerate(
+            numbered, start=first_line_number + 1
+        ):
+            if line_number != expected:
+                raise InvalidFormatError("line numbers are not contiguous")
+
+            lines.append(line)
+
+        return cls(lines, first_line_number)
+
+    def __bool__(self):
+        return self.position < len(self.lines)
+
+    def __repr__(self):
+        return f"LineCursor(line_number={self.line_number}, n_lines={len(self.lines)})"
+
+    @property
+    def line_number(self):
+        """the line number of the current line"""
+        return self.first_line_number + self.position
+
+    def peek(self, offset=0):
+        """the line at the offset from the current line, or ``None``"""
+        index = self.position + offset
+        if index >= len(self.lines):
+            return None
+
+        return self.lines[index]
+
+    def advance(self, n=1):
+        self.position = min(self.position + n, len(self.lines))
+
+    def skip_while(self, predicate):
+        """advance while the current line matches the predicate"""
+        lines = self.lines
+        position = self.position
+        while position < len(lines) and predicate(lines[position]):
+            position += 1
+
+        self.position = position
+
+    def mark(self):
+        return self.position
+
+    def reset(self, mark):
+        self.position = mark
+
+    def lines_since(self, mark, stop=None):
+        return self.lines[mark : self.position if stop is None else stop]
+
+    def unit(self, name, mark, stop=None):
+        """construct a unit of the lines between the mark and the current line"""
+        if stop is None:
+            stop = self.position
+
+        line_range = (self.first_line_number + mark, self.first_line_number + stop)
+
+        return line_range, name, "\n".join(self.lines_since(mark, stop))
+
+
+class PeekableLines:
+    """view of a cursor that behaves like ``more_itertools.peekable``
+
+    For detection functions that expect an iterator of line numbers and
+    lines.
+    """
+
+    __slots__ = ("cursor",)
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __bool__(self):
+        return bool(self.cursor)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = self.peek()
+        self.cursor.advance()
+
+        return item
+
+    def peek(self, default=_missing):
+        cursor = self.cursor
+        if not cursor:
+            if default is _missing:
+                raise StopIteration
+            return default
+
+        return cursor.line_number, cursor.peek()
+
+    def prepend(self, *items):
+        """push back the most recently consumed items"""
+        cursor = self.cursor
+        start = cursor.position - len(items)
+        consumed = tuple(
+            (cursor.first_line_number + index, cursor.lines[index])
+            for index in range(max(start, 0), cursor.position)
+        )
+        if start < 0 or consumed != tuple(items):
+            raise ValueError("can only prepend the most recently consumed lines")
+
+        cursor.reset(start)
+
+
+def adapt_detection_func(func):
+    """wrap a detection function that expects a ``peekable`` of numbered lines"""
+
+    @functools.wraps(func)
+    def wrapper(lines):
+        return func(PeekableLines(lines))
+
+    return wrapper
@@ -1,8 +1,6 @@
-import ast
 import io
 import itertools
 import re
-import sys
 import tokenize
 from tokenize import TokenError
 
@@ -17,45 +15,28 @@ prompt_re = re.compile(r"(>>> ?)")
 continuation_prompt = "..."
 continuation_prompt_re = re.compile(r"(\.\.\. ?)")
 include_pattern = r"\.pyi?$"
+markers = (">>>",)
+leading_characters = ">"
+uses_line_cursor = True
 block_start_re = re.compile(r"^[^#:]+:(\s*#.*)?$")
+# keywords that continue a compound statement
+clause_keywords = {"elif", "else", "except", "finally"}
 
 
 def continuation_lines(lines):
-    while True:
-        try:
-            line_number, line = lines.peek()
-        except StopIteration:
-            line_number = -1
-            line = ""
-
-        if not continuation_prompt_re.match(line.lstrip()):
-            break
-
-        # actually consume the item
-        more_itertools.consume(lines, n=1)
-
-        yield line_number, line
+    lines.skip_while(lambda line: continuation_prompt_re.match(line.lstrip()))
 
 
 def detection_func(lines):
-    try:
-        _, line = lines.peek()
-    except StopIteration:
-        line = ""
-
-    if not prompt_re.match(line.lstrip()):
+    line = lines.peek()
+    if line is None or not prompt_re.match(line.lstrip()):
         return None
 
-    detected_lines = list(
-        itertools.chain([more_itertools.first(lines)], continuation_lines(lines))
-    )
-    line_numbers, lines = map(tuple, more_itertools.unzip(detected_lines))
-
-    line_range = min(line_numbers), max(line_numbers) + 1
-    if line_numbers != tuple(range(line_range[0], line_range[1])):
-        raise InvalidFormatError("line numbers are not contiguous")
+    start = lines.mark()
+    lines.advance()
+    continuation_lines(lines)
 
-    return line_range, name, "\n".join(lines)
+    return lines.unit(name, start)
 
 
 def suppress(iterable, errors):
@@ -95,6 +76,9 @@ def detect_docstring_quotes(code_unit):
         else:
             return None
 
+    if "'''" not in code_unit and '"""' not in code_unit:
+        return None
+
     string_tokens = list(extract_string_tokens(code_unit))
     token_quotes = {token: extract_quotes(token.string) for token in string_tokens}
     quotes = (quote for quote in token_quotes.values() if quote is not None)
@@ -136,81 +120,106 @@ def extraction_func(line):
     }, extracted_line
 
 
-def restore_quotes(code_unit, original_quotes):
-    def line_offsets(code_unit):
-        offsets = [m.end() for m in re.finditer("\n", code_unit)]
+def is_single_statement(code_unit):
+    """check whether the formatted code unit can only contain a single statement
 
-        return {lineno: offset for lineno, offset in enumerate([0] + offsets, start=1)}
+    After formatting, additional statements start on a new line without
+    indentation. Apart from that, lines without indentation can only contain
+    closing brackets or be part of a multi-line string.
+    """
+    if "'''" in code_unit or '"""' in code_unit:
+        return False
 
-    def compute_offset(pos, offsets):
-        lineno, charno = pos
-        return offsets[lineno] + charno
+    lines = code_unit.split("\n")
 
-    if original_quotes is None:
-        return code_unit
+    return all(not line or line[0] in " \t)]}" for line in lines[1:])
 
-    to_replace = "'''" if original_quotes == '"""' else '"""'
 
-    string_tokens = extract_string_tokens(code_unit)
-    triple_quote_tokens = [
-        token
-        for token in string_tokens
-        if token.string.startswith(to_replace) and token.string.endswith(to_replace)
-    ]
+def scan_code_unit(code_unit, original_quotes):
+    """restore the quotes of triple-quoted strings and find the statements
 
-    offsets = line_offsets(code_unit)
+    The tokens of the code unit are visited only once. Returns the code unit
+    with restored quotes and the (0-based) indices of the lines where the
+    top-level statements start.
+    """
+    to_replace = None
+    if original_quotes is not None:
+        to_replace = "'''" if original_quotes == '"""' else '"""'
+
+    ignored_types = {tokenize.NL, tokenize.COMMENT, tokenize.ENDMARKER}
+
+    strings = []
+    statement_starts = []
+    depth = 0
+    at_statement_start = True
+    decorated = False
+    for token in tokenize_string(code_unit):
+        if token.type == tokenize.INDENT:
+            depth += 1
+            continue
+        elif token.type == tokenize.DEDENT:
+            depth -= 1
+            continue
+        elif token.type in ignored_types:
+            continue
+
+        if at_statement_start and depth == 0:
+            lineno = token.start[0] - 1
+            if (
+                not decorated
+                and token.string not in clause_keywords
+                and (not statement_starts or statement_starts[-1] != lineno)
+            ):
+                statement_starts.append(lineno)
+
+            # decorators are part of the statement of the decorated definition
+            decorated = token.type == tokenize.OP and token.string == "@"
+        at_statement_start = token.type == tokenize.NEWLINE or (
+            token.type == tokenize.OP and token.string == ";"
+        )
+
+        if (
+            to_replace is not None
+            and token.type == tokenize.STRING
+            and token.string.startswith(to_replace)
+            and token.string.endswith(to_replace)
+        ):
+            strings.append(token)
+
+    if not strings:
+        return code_unit, statement_starts
+
+    offsets = [0] + [m.end() for m in re.finditer("\n", code_unit)]
     mutable_string = io.StringIO(code_unit)
-    for token in triple_quote_tokens:
-        # find the offset in the stream
-        start = compute_offset(token.start, offsets)
-        end = compute_offset(token.end, offsets) - 3
+    for token in strings:
+        (start_line, start_column), (end_line, end_column) = token.start, token.end
 
-        mutable_string.seek(start)
+        mutable_string.seek(offsets[start_line - 1] + start_column)
         mutable_string.write(original_quotes)
 
-        mutable_string.seek(end)
+        mutable_string.seek(offsets[end_line - 1] + end_column - 3)
         mutable_string.write(original_quotes)
 
-    restored_code_unit = mutable_string.getvalue()
+    return mutable_string.getvalue(), statement_starts
 
-    return restored_code_unit
 
-
-def split_by_statement(code_unit):
+def split_by_statement(code_unit, original_quotes=None):
     """split a code unit into individual statements
 
     At this point, the only way to have more than a single statement
     is by joining multiple (non-block) statements with a `;`.
-    """
 
-    def lineno(node):
-        # TODO: remove once we drop support for python=3.7
-        version = (sys.version_info.major, sys.version_info.minor)
-
-        if (
-            version < (3, 8)
-            and isinstance(node, ast.Expr)
-            and isinstance(node.value, ast.Str)
-        ):
-            # bug in ast (fixed in py38): lineno is wrong for multi-line string expressions
-            # https://bugs.python.org/issue16806
-            n_lines = len(node.value.s.split("\n"))
-            lineno = node.lineno - n_lines + 1
-        elif isinstance(node, (ast.FunctionDef, ast.ClassDef)):
-            linenos = [node.lineno] + [dec.lineno for dec in node.decorator_list]
-            lineno = min(linenos)
-        else:
-            lineno = node.lineno
-
-        return lineno
+    Triple-quoted strings are changed back to the original quotes.
+    """
+    if original_quotes is None and is_single_statement(code_unit):
+        return [code_unit.split("\n")]
 
-    content = ast.parse(code_unit).body
+    code_unit, indices = scan_code_unit(code_unit, original_quotes)
 
     lines = code_unit.split("\n")
-    if not content:
+    if not indices:
         return [lines]
 
-    indices = [lineno(obj) - 1 for obj in content]
     # make sure comments are included
     indices[0] = 0
     slices = more_itertools.zip_offset(indices, indices, offsets=(0, 1), longest=True)
@@ -265,9 +274,7 @@ def reformatting_func(code_unit, docstring_quotes):
             (add_prompt(continuation_prompt, line) for line in lines_),
         )
 
-    restored_quotes = restore_quotes(code_unit.rstrip(), docstring_quotes)
-
-    subunits = split_by_statement(restored_quotes)
+    subunits = split_by_statement(code_unit.rstrip(), docstring_quotes)
 
     return "\n".join(
         itertools.chain.from_iterable(reformat_code_unit(unit) for unit in subunits)
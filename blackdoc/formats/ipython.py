@@ -17,31 +17,27 @@ magic_re = re.compile(r"^(!.*|%.*|@[a-zA-Z_][a-zA-Z0-9_]* .+)")
 magic_comment = "<ipython-magic>"
 
 include_pattern = r"\.pyi?$"
+markers = ("In [",)
+leading_characters = "I"
+uses_line_cursor = True
 
 
 def continuation_lines(lines, indent, prompt_length):
-    while True:
-        try:
-            line_number, line = lines.peek()
-        except StopIteration:
-            line_number = -1
-            line = ""
-
+    def is_continuation_line(line):
         match = continuation_prompt_re.match(line)
-        if not match or len(match.groupdict()["indent"]) - prompt_length + 5 != indent:
-            break
 
-        # actually consume the item
-        more_itertools.consume(lines, n=1)
+        return (
+            match is not None
+            and len(match.groupdict()["indent"]) - prompt_length + 5 == indent
+        )
 
-        yield line_number, line
+    lines.skip_while(is_continuation_line)
 
 
 def detection_func(lines):
-    try:
-        _, line = lines.peek()
-    except StopIteration:
-        line = ""
+    line = lines.peek()
+    if line is None:
+        return None
 
     match = prompt_re.match(line)
     if not match:
@@ -51,19 +47,11 @@ def detection_func(lines):
     indent = len(groups["indent"])
     prompt_length = len(groups["prompt"])
 
-    detected_lines = list(
-        itertools.chain(
-            [more_itertools.first(lines)],
-            continuation_lines(lines, indent, prompt_length),
-        )
-    )
-    line_numbers, lines = map(tuple, more_itertools.unzip(detected_lines))
-
-    line_range = min(line_numbers), max(line_numbers) + 1
-    if line_numbers != tuple(range(line_range[0], line_range[1])):
-        raise InvalidFormatError("line numbers are not contiguous")
+    start = lines.mark()
+    lines.advance()
+    continuation_lines(lines, indent, prompt_length)
 
-    return line_range, name, "\n".join(lines)
+    return lines.unit(name, start)
 
 
 def is_ipython(line):
@@ -1,11 +1,11 @@
-import itertools
+import bisect
 import re
 import textwrap
 
-import more_itertools
-
+from blackdoc.formats.cursor import LineCursor
 from blackdoc.formats.errors import InvalidFormatError
 from blackdoc.formats.ipython import hide_magic, reveal_magic
+from blackdoc.formats.rst import directive_re as rst_directive_re
 from blackdoc.formats.rst import has_prompt
 
 name = "markdown"
@@ -32,8 +32,16 @@ directive_re = re.compile(
     $
     """
 )
+# fenced code blocks in other languages, with an info string
+foreign_fence_re = re.compile(r"^[ ]*(?P<fences>`{3,})\s*[^`\s][^`]*$")
+
 include_pattern = r"\.md$"
+# code blocks can also be used in docstrings (e.g. with mkdocstrings)
+detection_pattern = r"\.(md|pyi?)$"
+markers = ("```", ":::")
+leading_characters = "`:"
 supported_blocks = ("python", "python3", "jupyter-execute", "code-cell")
+uses_line_cursor = True
 
 
 def preprocess_directive(directive):
@@ -47,122 +55,231 @@ def preprocess_directive(directive):
     return new
 
 
-def take_while(iterable, predicate):
-    while True:
-        try:
-            taken = next(iterable)
-        except StopIteration:
-            break
-
-        if not predicate(taken):
-            iterable.prepend(taken)
-            break
-
-        yield taken
-
-
 def extract_options(lines, fences):
-    taken = lines.peek()
-    line = taken if isinstance(taken, str) else taken[1]
-
-    if line.strip() != "---":
+    line = lines.peek()
+    if line is None or line.strip() != "---":
         return ()
 
-    options = [next(lines)]
+    start = lines.mark()
+    lines.advance()
     # potentially found options
     while True:
-        try:
-            taken = next(lines)
-        except StopIteration:
+        line = lines.peek()
+        if line is None:
             break
 
-        options.append(taken)
-
-        line = taken if isinstance(taken, str) else taken[1]
+        lines.advance()
         if line.strip() == "---":
             break
         elif line.strip() == fences:
-            lines.prepend(*options)
+            lines.reset(start)
             return ()
 
-    return tuple(options)
+    return tuple(lines.lines_since(start))
 
 
-def continuation_lines(lines, indent, fences):
-    options = extract_options(lines, fences)
-    newlines = tuple(take_while(lines, lambda x: not x[1].strip()))
+def contains_code(lines):
+    """check whether the lines contain prompts, directives or code blocks"""
+    return any(
+        has_prompt(stripped)
+        or rst_directive_re.match(stripped) is not None
+        or opening_fence(stripped) is not None
+        for stripped in map(str.lstrip, lines)
+        # only lines starting with these characters can be code
+        if stripped[:1] in ">I.`:"
+    )
 
-    _, next_line = lines.peek((0, None))
-    if has_prompt(next_line):
-        lines.prepend(*options, *newlines)
-        raise RuntimeError("prompt detected")
 
-    yield from options
-    yield from newlines
-    yield from take_while(lines, lambda x: x[1].strip() != fences)
+def opening_fence(line):
+    """parse the opening fence of a code block
 
+    Returns the fence and whether the code block contains python code, or
+    ``None`` if the line does not open a code block.
+    """
+    match = directive_re.match(line)
+    if match is not None:
+        directive = preprocess_directive(match.groupdict())
+        if directive["block_type"] in supported_blocks and (
+            directive["block_type"] != "code-cell" or directive["language"] == "python"
+        ):
+            return directive["fences"], True
 
-def detection_func(lines):
-    try:
-        line_number, line = lines.peek()
-    except StopIteration:
-        return None
+    match = foreign_fence_re.match(line)
+    if match is not None:
+        return match.group("fences"), False
 
-    match = directive_re.match(line)
-    if not match:
-        return None
+    return None
+
+
+class FenceIndex:
+    """pairs of opening and closing fences of the code blocks in a document
+
+    The index is built in a single pass over the document, and unclosed
+    python code blocks are reported immediately.
+    """
+
+    __slots__ = ("lines", "fences", "dashes", "blocks")
+
+    def __init__(self, lines, first_line_number=1):
+        self.lines = lines
+
+        # lines consisting only of a fence or of an option header separator
+        self.fences = {"`": ([], []), ":": ([], [])}
+        self.dashes = []
+        openers = []
+        for position, line in enumerate(lines):
+            stripped = line.strip()
+            if not stripped:
+                continue
+
+            char = stripped[0]
+            if char not in "`:-":
+                continue
+            elif stripped == "---":
+                self.dashes.append(position)
+            elif char == "-":
+                continue
+            elif stripped == char * len(stripped):
+                positions, lengths = self.fences[char]
+                positions.append(position)
+                lengths.append(len(stripped))
+            else:
+                openers.append(position)
+
+        self.blocks = {}
+        unclosed = []
+        end = 0
+        for position in openers:
+            if position < end:
+                # part of the previous code block
+                continue
+
+            block = self.find_block(position)
+            if block is None:
+                continue
+
+            closing, _, is_python = block
+            if closing is None:
+                if is_python:
+                    unclosed.append(first_line_number + position)
+                continue
+
+            self.blocks[position] = block
+            end = closing + 1
+
+        if unclosed:
+            line_numbers = ", ".join(str(line_number) for line_number in unclosed)
+            raise InvalidFormatError(
+                f"found code blocks without closing fence starting at lines {line_numbers}"
+            )
+
+    def closing_fence(self, position, fences, exact):
+        """find the line closing the fences opened at the position"""
+        positions, lengths = self.fences[fences[0]]
+        for index in range(bisect.bisect_right(positions, position), len(positions)):
+            length = lengths[index]
+            if length == len(fences) or (not exact and length > len(fences)):
+                return positions[index]
 
-    directive = preprocess_directive(match.groupdict())
-    if directive["block_type"] not in supported_blocks:
         return None
-    if directive["block_type"] in {"code-cell"} and directive["language"] != "python":
+
+    def find_block(self, position):
+        """determine the extent of the code block opened at the position
+
+        Returns the position of the closing fence, the position of the first
+        line after the options header and whether the code block contains
+        python code.
+        """
+        block = self.blocks.get(position)
+        if block is not None:
+            return block
+
+        opening = opening_fence(self.lines[position])
+        if opening is None:
+            return None
+
+        fences, is_python = opening
+        # python code blocks require the exact fence, others are closed by
+        # at least as many backticks
+        closing = self.closing_fence(position, fences, exact=is_python)
+        if closing is None or not is_python:
+            return closing, None, is_python
+
+        options_end = position + 1
+        if self.lines[options_end].strip() == "---":
+            index = bisect.bisect_right(self.dashes, options_end)
+            if index < len(self.dashes) and self.dashes[index] < closing:
+                options_end = self.dashes[index] + 1
+
+        return closing, options_end, is_python
+
+
+def fence_index(lines):
+    """get the fence index of the document, cached on the line cursor"""
+    index = lines.cache.get(name)
+    if index is None:
+        index = FenceIndex(lines.lines, lines.first_line_number)
+        lines.cache[name] = index
+
+    return index
+
+
+def detection_func(lines):
+    line = lines.peek()
+    if line is None:
         return None
 
-    indent = len(directive.pop("indent"))
+    index = fence_index(lines)
+    start = lines.mark()
 
-    start_line = more_itertools.first(lines)
-    try:
-        content_lines = list(continuation_lines(lines, indent, directive["fences"]))
-    except RuntimeError as e:
-        if str(e) != "prompt detected":
-            raise
+    block = index.find_block(start)
+    if block is None:
+        return None
+
+    closing, options_end, is_python = block
+    if closing is None:
+        if is_python:
+            raise InvalidFormatError(
+                "found a code block without closing fence starting at line"
+                f" {lines.line_number}"
+            )
 
-        lines.prepend((line_number, line))
+        # not closed, so this is not a code block
         return None
 
-    try:
-        line_number, stop_line = lines.peek()
-    except StopIteration:
-        line_number = -1
-        stop_line = None
+    if not is_python:
+        # code blocks in other languages are passed through as a whole, unless
+        # their content has to be detected
+        if contains_code(lines.lines[start + 1 : closing]):
+            return None
 
-    if stop_line.strip() != directive.get("fences"):
-        raise RuntimeError("found a code block without closing fence")
+        lines.advance(closing + 1 - start)
+        return lines.unit("none", start)
 
-    detected_lines = list(
-        itertools.chain([start_line], content_lines, [more_itertools.first(lines)])
-    )
+    lines.advance(options_end - start)
+    lines.skip_while(lambda line: not line.strip())
+    if lines.mark() < closing and has_prompt(lines.peek()):
+        lines.reset(start)
+        return None
 
-    line_numbers, lines = map(tuple, more_itertools.unzip(detected_lines))
-    line_range = min(line_numbers), max(line_numbers) + 2
-    if line_numbers != tuple(range(line_range[0], line_range[1] - 1)):
-        raise RuntimeError("line numbers are not contiguous")
+    lines.reset(closing + 1)
 
-    return line_range, name, "\n".join(lines)
+    return lines.unit(name, start)
 
 
 def extraction_func(code):
-    lines = more_itertools.peekable(iter(code.split("\n")))
+    lines = LineCursor(code.split("\n"))
 
-    match = directive_re.fullmatch(more_itertools.first(lines))
+    match = directive_re.fullmatch(lines.peek())
     if not match:
         raise InvalidFormatError(f"misformatted code block:\n{code}")
+    lines.advance()
 
     directive = preprocess_directive(match.groupdict())
     directive.pop("indent")
     directive["options"] = extract_options(lines, directive["fences"])[1:-1]
 
-    lines_ = tuple(lines)
+    lines_ = lines.lines[lines.mark() :]
     if len(lines_) == 0:
         raise InvalidFormatError("misformatted code block: could not find any code")
 
@@ -1,11 +1,12 @@
-import more_itertools
-
 name = "none"
+uses_line_cursor = True
 
 
 def detection_func(lines):
-    number, line = more_itertools.first(lines)
-    return (number, number + 1), name, line
+    start = lines.mark()
+    lines.advance()
+
+    return lines.unit(name, start)
 
 
 def extraction_func(line):
@@ -1,11 +1,17 @@
+import re
 import warnings
 
 import more_itertools
 
+from blackdoc.formats.cursor import adapt_detection_func
+
 detection_funcs = {}
 extraction_funcs = {}
 reformatting_funcs = {}
 include_patterns = {}
+markers = {}
+leading_characters = {}
+detection_patterns = {}
 
 
 def format_include_patterns():
@@ -18,6 +24,58 @@ def format_include_patterns():
         return f"({joined_patterns})"
 
 
+def detection_markers():
+    """collect the markers of all enabled formats
+
+    Returns ``None`` if any of the enabled formats does not declare markers.
+    """
+    names = [name for name in detection_funcs if name != "none"]
+    if any(name not in markers for name in names):
+        return None
+
+    return tuple(
+        sorted({marker.encode() for name in names for marker in markers[name]})
+    )
+
+
+def may_contain_code(data):
+    """check whether the raw content of a file may contain code units
+
+    A file without any of the markers of the enabled formats can be skipped
+    without decoding it.
+    """
+    markers_ = detection_markers()
+    if markers_ is None:
+        return True
+
+    return any(marker in data for marker in markers_)
+
+
+def formats_for(path):
+    """select the formats that can appear in the file
+
+    Formats with a detection pattern are only used for files matching the
+    pattern, while formats without are used for every file. Files not
+    matched by any pattern use all formats.
+    """
+    path = str(path)
+
+    restricted = {
+        name: pattern
+        for name, pattern in detection_patterns.items()
+        if name in detection_funcs
+    }
+    matching = {
+        name for name, pattern in restricted.items() if re.search(pattern, path)
+    }
+    if not matching:
+        return tuple(detection_funcs)
+
+    return tuple(
+        name for name in detection_funcs if name not in restricted or name in matching
+    )
+
+
 def disable(format_names):
     names = tuple(more_itertools.always_iterable(format_names))
     unknown_names = tuple(name for name in names if name not in detection_funcs)
@@ -37,6 +95,13 @@ def register_format(name, obj):
     extraction_func = getattr(obj, "extraction_func")
     reformatting_func = getattr(obj, "reformatting_func")
     include_pattern = getattr(obj, "include_pattern", None)
+    markers_ = getattr(obj, "markers", None)
+    leading_characters_ = getattr(obj, "leading_characters", None)
+    detection_pattern = getattr(obj, "detection_pattern", None)
+
+    if not getattr(obj, "uses_line_cursor", False):
+        # detection functions written for `more_itertools.peekable`
+        detection_func = adapt_detection_func(detection_func)
 
     detection_funcs[name] = detection_func
     extraction_funcs[name] = extraction_func
@@ -44,3 +109,12 @@ def register_format(name, obj):
 
     if include_pattern is not None:
         include_patterns[name] = include_pattern
+
+    if markers_ is not None:
+        markers[name] = tuple(markers_)
+
+    if leading_characters_ is not None:
+        leading_characters[name] = leading_characters_
+
+    if detection_pattern is not None:
+        detection_patterns[name] = detection_pattern
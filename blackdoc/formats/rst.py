@@ -1,9 +1,12 @@
-import itertools
 import re
 import textwrap
 
-import more_itertools
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
 
+from blackdoc.formats.cursor import LineCursor
 from blackdoc.formats.doctest import prompt_re as doctest_prompt_re
 from blackdoc.formats.errors import InvalidFormatError
 from blackdoc.formats.ipython import hide_magic, reveal_magic
@@ -15,8 +18,27 @@ directive_re = re.compile(
     "(?P<indent>[ ]*).. (?P<name>[a-z][-a-z]*)::(?: (?P<language>[a-z]+))?"
 )
 option_re = re.compile(r"^\s*:[^:]+:")
+# the expanded form of a literal block
+literal_block_re = re.compile(r"(?P<indent>[ ]*)::\s*$")
+# number of lines of a block after which the search for its end is
+# vectorized using `IndentationMap`
+vectorize_threshold = 256
+python_directives = (
+    "code",
+    "code-block",
+    "ipython",
+    "testcode",
+    "testsetup",
+    "testcleanup",
+)
 
 include_pattern = r"\.rst$"
+# directives can also be used in docstrings and in myst's eval-rst blocks
+detection_pattern = r"\.(pyi?|rst|md)$"
+# all directives end with a double colon
+markers = ("::",)
+leading_characters = ".:"
+uses_line_cursor = True
 
 
 def has_prompt(line):
@@ -26,123 +48,217 @@ def has_prompt(line):
     )
 
 
-def take_while(iterable, predicate):
-    while True:
-        try:
-            taken = next(iterable)
-        except StopIteration:
-            break
+def is_blank(line):
+    return not line.strip()
+
+
+def scan_block(lines, position, indent, stop):
+    """search the lines up to ``stop`` for the end of an indented block
+
+    Returns the end of the block and whether a line ending the block was
+    found.
+    """
+    end = position
+    for index in range(position, min(stop, len(lines))):
+        line = lines[index]
+        stripped = line.lstrip()
+        if not stripped:
+            continue
+        elif len(line) - len(stripped) <= indent:
+            return end, True
+
+        end = index + 1
+
+    return end, False
+
+
+def block_end(lines, position, indent):
+    """find the end of the block of lines indented by more than ``indent``
+
+    Trailing blank lines are not part of the block.
+    """
+    end, _ = scan_block(lines, position, indent, len(lines))
+
+    return end
+
+
+class IndentationMap:
+    """the indentation of the lines of a document as arrays
+
+    Blank lines are assigned the largest possible indentation, such that they
+    never end a block.
+    """
+
+    __slots__ = ("indentation", "last_nonblank")
+
+    def __init__(self, lines):
+        n_lines = len(lines)
+        lengths = np.fromiter(map(len, lines), dtype=np.int64, count=n_lines)
+        stripped_lengths = np.fromiter(
+            map(len, map(str.lstrip, lines)), dtype=np.int64, count=n_lines
+        )
+        blank = stripped_lengths == 0
+
+        self.indentation = np.where(
+            blank, np.iinfo(np.int64).max, lengths - stripped_lengths
+        )
+        # the position of the last non-blank line at or before each line
+        self.last_nonblank = np.maximum.accumulate(
+            np.where(blank, -1, np.arange(n_lines))
+        )
+
+    def block_end(self, position, indent, start=None):
+        """vectorized version of `block_end`
+
+        If given, the search starts at ``start`` instead of ``position``, for
+        blocks whose first lines are already known to be part of the block.
+        """
+        n_lines = len(self.indentation)
+
+        # search in windows of increasing size to avoid comparing the
+        # indentation of the rest of the document for every block
+        stop = n_lines
+        if start is None:
+            start = position
+        window = 64
+        while start < n_lines:
+            window_stop = min(start + window, n_lines)
+            (found,) = np.nonzero(self.indentation[start:window_stop] <= indent)
+            if found.size > 0:
+                stop = start + int(found[0])
+                break
+
+            start = window_stop
+            window *= 4
 
-        if not predicate(taken):
-            iterable.prepend(taken)
-            break
+        if stop <= position:
+            return position
 
-        yield taken
+        return max(int(self.last_nonblank[stop - 1]) + 1, position)
+
+
+def find_block_end(lines, indent):
+    """find the end of the block indented by more than ``indent``
+
+    If ``numpy`` is installed, the search for the end of large blocks is
+    vectorized.
+    """
+    position = lines.mark()
+    if np is None:
+        return block_end(lines.lines, position, indent)
+
+    # most blocks are short, and these are faster to scan directly
+    stop = position + vectorize_threshold
+    end, found = scan_block(lines.lines, position, indent, stop)
+    if found or stop >= len(lines.lines):
+        return end
+
+    indentation_map = lines.cache.get(name)
+    if indentation_map is None:
+        indentation_map = IndentationMap(lines.lines)
+        lines.cache[name] = indentation_map
+
+    # the block can end right after the scanned lines, so trailing blank lines
+    # of these lines must not become part of the block
+    return indentation_map.block_end(position, indent, start=stop)
 
 
 def continuation_lines(lines, indent):
-    options = tuple(take_while(lines, lambda x: option_re.match(x[1])))
-    newlines = tuple(take_while(lines, lambda x: not x[1].strip()))
-    decorator_lines = tuple(take_while(lines, lambda x: x[1].lstrip().startswith("@")))
-    _, next_line = lines.peek((0, None))
+    """advance to the end of the directive's content
+
+    Returns ``False`` if the content contains prompts.
+    """
+    start = lines.mark()
+
+    lines.skip_while(option_re.match)
+    lines.skip_while(is_blank)
+    lines.skip_while(lambda line: line.lstrip().startswith("@"))
+    next_line = lines.peek()
     if next_line is None:
-        return
+        lines.reset(start)
+        return True
 
     if has_prompt(next_line):
-        lines.prepend(*options, *newlines, *decorator_lines)
-        raise RuntimeError("prompt detected")
+        return False
+
+    lines.reset(find_block_end(lines, indent))
 
-    yield from options
-    yield from newlines
-    yield from decorator_lines
+    return True
 
-    while True:
-        newlines = tuple(take_while(lines, lambda x: not x[1].strip()))
-        try:
-            line_number, line = lines.peek()
-        except StopIteration:
-            lines.prepend(*newlines)
-            break
 
-        current_indent = len(line) - len(line.lstrip())
-        if current_indent <= indent:
-            # put back the newlines, if any
-            lines.prepend(*newlines)
-            break
+def pass_through(lines, indent):
+    """claim a directive or literal block that does not contain python code
 
-        yield from newlines
+    Blocks containing prompts or other directives are not claimed, such that
+    their content can be detected.
+    """
+    start = lines.mark()
+    lines.advance()
+    if not continuation_lines(lines, indent):
+        lines.reset(start)
+        return None
 
-        # consume the line
-        more_itertools.consume(lines, n=1)
+    # only lines starting with these characters can be prompts or directives
+    if any(
+        stripped[:1] in ">I." and (has_prompt(stripped) or directive_re.match(stripped))
+        for stripped in map(str.lstrip, lines.lines_since(start + 1))
+    ):
+        lines.reset(start)
+        return None
 
-        yield line_number, line
+    return lines.unit("none", start)
 
 
 def detection_func(lines):
-    try:
-        line_number, line = lines.peek()
-    except StopIteration:
+    line = lines.peek()
+    if line is None:
         return None
 
     match = directive_re.match(line)
     if not match:
-        return None
+        match = literal_block_re.match(line)
+        if match is None:
+            return None
+
+        return pass_through(lines, len(match.group("indent")))
 
     directive = match.groupdict()
+    indent = len(directive.pop("indent"))
 
-    if directive["name"] not in (
-        "code",
-        "code-block",
-        "ipython",
-        "testcode",
-        "testsetup",
-        "testcleanup",
-    ):
-        return None
+    if directive["name"] not in python_directives:
+        return pass_through(lines, indent)
 
     if directive["language"] not in ("python", None):
-        return None
+        return pass_through(lines, indent)
 
-    indent = len(directive.pop("indent"))
-
-    try:
-        detected_lines = list(
-            itertools.chain(
-                [more_itertools.first(lines)],
-                continuation_lines(lines, indent),
-            )
-        )
-    except RuntimeError as e:
-        if str(e) != "prompt detected":
-            raise
-
-        lines.prepend((line_number, line))
+    start = lines.mark()
+    lines.advance()
+    if not continuation_lines(lines, indent):
+        lines.reset(start)
         return None
 
-    line_numbers, lines = map(tuple, more_itertools.unzip(detected_lines))
-    line_range = min(line_numbers), max(line_numbers) + 1
-    if line_numbers != tuple(range(line_range[0], line_range[1])):
-        raise RuntimeError("line numbers are not contiguous")
-
-    return line_range, name, "\n".join(lines)
+    return lines.unit(name, start)
 
 
 def extraction_func(code):
-    lines = more_itertools.peekable(iter(code.split("\n")))
+    lines = LineCursor(code.split("\n"))
 
-    match = directive_re.fullmatch(more_itertools.first(lines))
+    match = directive_re.fullmatch(lines.peek())
     if not match:
         raise InvalidFormatError(f"misformatted code block:\n{code}")
+    lines.advance()
 
     directive = match.groupdict()
     directive.pop("indent")
 
+    options_start = lines.mark()
+    lines.skip_while(option_re.match)
     directive["options"] = tuple(
-        line.strip() for line in take_while(lines, lambda line: option_re.match(line))
+        line.strip() for line in lines.lines_since(options_start)
     )
 
     # correct a missing newline
-    newline = lines.peek(None)
+    newline = lines.peek()
     if newline is None:
         raise InvalidFormatError(
             "misformatted code block:"
@@ -150,9 +266,9 @@ def extraction_func(code):
             " but found <end-of-file>"
         )
     elif not newline.strip():
-        more_itertools.first(lines)
+        lines.advance()
 
-    lines_ = tuple(lines)
+    lines_ = lines.lines[lines.mark() :]
     if len(lines_) == 0:
         raise InvalidFormatError("misformatted code block: could not find any code")
 
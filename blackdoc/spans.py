@@ -0,0 +1,108 @@
+"""code units as spans of the original content
+
+Instead of assembling the output from the text of every unit, only the spans
+of units that changed are replaced while everything else is copied directly
+from the original content.
+"""
+
+import array
+
+
+class Span:
+    """the location of a code unit within the content
+
+    ``start`` and ``stop`` are character offsets, ``line_range`` is the range
+    of (1-based) line numbers.
+    """
+
+    __slots__ = ("start", "stop", "line_range")
+
+    def __init__(self, start, stop, line_range):
+        self.start = start
+        self.stop = stop
+        self.line_range = line_range
+
+    def __repr__(self):
+        return (
+            f"Span(start={self.start}, stop={self.stop}, line_range={self.line_range})"
+        )
+
+    def __eq__(self, other):
+        if not isinstance(other, Span):
+            return NotImplemented
+
+        return (self.start, self.stop, self.line_range) == (
+            other.start,
+            other.stop,
+            other.line_range,
+        )
+
+
+def line_offsets(content):
+    """compute the offsets of the start of each line"""
+    offsets = array.array("q", [0])
+
+    index = content.find("\n")
+    while index != -1:
+        offsets.append(index + 1)
+        index = content.find("\n", index + 1)
+
+    return offsets
+
+
+def to_span(offsets, length, line_range, first_line_number=1):
+    """convert a range of line numbers to a span
+
+    The newline character separating the unit from the next line is not part
+    of the span. ``first_line_number`` is the line number of the first line of
+    the content.
+    """
+    first, last = line_range
+    first -= first_line_number
+    last -= first_line_number
+
+    start = offsets[first]
+    stop = offsets[last] - 1 if last < len(offsets) else length
+
+    return Span(start, stop, line_range)
+
+
+def unit_spans(content, labeled, first_line_number=1):
+    """determine the spans of the code units
+
+    Units without code are skipped.
+    """
+    offsets = line_offsets(content)
+    length = len(content)
+
+    for line_range, code_format, line_unit in labeled:
+        if code_format == "none":
+            continue
+
+        span = to_span(offsets, length, line_range, first_line_number)
+        yield span, code_format, line_unit
+
+
+def splice(content, replacements):
+    """replace the spans of the content
+
+    ``replacements`` are pairs of spans and their new text, ordered by the
+    start of the span. Replacements that don't change the content are
+    skipped, and if there are no changes the content is returned as-is.
+    """
+    pieces = []
+    position = 0
+    for span, text in replacements:
+        if len(text) == span.stop - span.start and content.startswith(text, span.start):
+            continue
+
+        pieces.append(content[position : span.start])
+        pieces.append(text)
+        position = span.stop
+
+    if not pieces:
+        return content
+
+    pieces.append(content[position:])
+
+    return "".join(pieces)
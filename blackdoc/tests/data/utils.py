@@ -11,11 +11,25 @@ def from_dict(labels):
     return line_ranges, line_labels
 
 
+def coalesce_labels(labels):
+    """merge consecutive ranges labeled as "none" """
+    coalesced = []
+    for range_, label in labels:
+        if coalesced and label == "none" and coalesced[-1][1] == "none":
+            (min_, _), _ = coalesced[-1]
+            _, max_ = range_
+            coalesced[-1] = ((min_, max_), label)
+        else:
+            coalesced.append((range_, label))
+
+    return coalesced
+
+
 def to_classification_format(labels, lines):
-    prepared_labels = dict(zip(*from_dict(labels)))
+    prepared_labels = coalesce_labels(zip(*from_dict(labels)))
     return tuple(
         ((min_ + 1, max_ + 1), label, "\n".join(lines[min_:max_]))
-        for (min_, max_), label in prepared_labels.items()
+        for (min_, max_), label in prepared_labels
     )
 
 
@@ -0,0 +1,148 @@
+import http.server
+import shutil
+import threading
+
+import black
+import pytest
+
+from blackdoc import backends
+
+
+@pytest.mark.parametrize(
+    ["mode", "expected"],
+    (
+        pytest.param(black.Mode(), {}, id="default"),
+        pytest.param(
+            black.Mode(line_length=79, string_normalization=False),
+            {"X-Line-Length": "79", "X-Skip-String-Normalization": "1"},
+            id="line_length",
+        ),
+        pytest.param(
+            black.Mode(
+                target_versions={black.TargetVersion.PY311, black.TargetVersion.PY310}
+            ),
+            {"X-Python-Variant": "py310,py311"},
+            id="target_versions",
+        ),
+        pytest.param(black.Mode(is_pyi=True), {"X-Python-Variant": "pyi"}, id="pyi"),
+    ),
+)
+def test_blackd_headers(mode, expected):
+    headers = backends.blackd_headers(mode)
+
+    assert headers.items() >= expected.items()
+
+
+class BlackdHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        code = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        try:
+            formatted = black.format_str(
+                code, mode=black.Mode(line_length=int(self.headers["X-Line-Length"]))
+            )
+        except black.InvalidInput as e:
+            status, body = 400, str(e)
+        else:
+            status, body = (204, "") if formatted == code else (200, formatted)
+
+        self.send_response(status)
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def blackd_url():
+    server = http.server.HTTPServer(("localhost", 0), BlackdHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield f"http://localhost:{server.server_port}"
+
+    server.shutdown()
+    server.server_close()
+
+
+def test_format_blackd(blackd_url):
+    mode = black.Mode()
+
+    assert backends.format_blackd("a  =  1", mode, url=blackd_url) == "a = 1\n"
+    assert backends.format_blackd("a = 1\n", mode, url=blackd_url) == "a = 1\n"
+    with pytest.raises(black.InvalidInput, match="Cannot parse"):
+        backends.format_blackd("a = = 1", mode, url=blackd_url)
+
+    with pytest.raises(backends.BackendError, match="cannot connect"):
+        backends.format_blackd("a = 1", mode, url="http://localhost:1")
+
+
+@pytest.mark.parametrize(
+    ["mode", "expected"],
+    (
+        pytest.param(black.Mode(), ["--config", "line-length = 88"], id="default"),
+        pytest.param(
+            black.Mode(
+                line_length=79,
+                string_normalization=False,
+                magic_trailing_comma=False,
+            ),
+            [
+                "--config",
+                "line-length = 79",
+                "--config",
+                "format.quote-style = 'preserve'",
+                "--config",
+                "format.skip-magic-trailing-comma = true",
+            ],
+            id="options",
+        ),
+        pytest.param(
+            black.Mode(
+                target_versions={black.TargetVersion.PY311, black.TargetVersion.PY39}
+            ),
+            ["--config", "line-length = 88", "--config", "target-version = 'py39'"],
+            id="target_versions",
+        ),
+        pytest.param(
+            black.Mode(target_versions={black.TargetVersion.PY33}),
+            ["--config", "line-length = 88", "--config", "target-version = 'py37'"],
+            id="old_target_versions",
+        ),
+    ),
+)
+def test_ruff_config(mode, expected):
+    assert backends.ruff_config(mode) == expected
+
+
+@pytest.mark.skipif(shutil.which("ruff") is None, reason="requires ruff")
+def test_format_ruff_batch():
+    codes = ["a  =  1", "def f(x) :\n  return x", "b = = 2", "\nc  =  3"]
+    expected = ["a = 1\n", "def f(x):\n    return x\n", None, "c = 3\n"]
+
+    actual = backends.format_ruff_batch(codes, black.Mode())
+
+    assert [
+        result if not isinstance(result, Exception) else None for result in actual
+    ] == expected
+    assert str(actual[2]) == "Cannot parse: 1:4: b = = 2"
+
+
+@pytest.mark.skipif(shutil.which("ruff") is None, reason="requires ruff")
+@pytest.mark.parametrize(
+    "code",
+    (
+        pytest.param("b = = 2", id="first_line"),
+        pytest.param("a = 1\nb = = 2", id="second_line"),
+        pytest.param("def f(:\n    pass", id="def"),
+    ),
+)
+def test_format_ruff_error_message(code):
+    mode = black.Mode()
+    with pytest.raises(black.InvalidInput) as expected:
+        backends.format_black(code, mode)
+
+    with pytest.raises(black.InvalidInput) as actual:
+        backends.format_ruff(code, mode)
+
+    assert str(actual.value) == str(expected.value)
@@ -1,6 +1,29 @@
+import sys
+import textwrap
+
+import black
 import pytest
 
-from blackdoc.blacken import parse_message
+from blackdoc.backends import format_black
+from blackdoc.blacken import (
+    UnitCache,
+    blacken_spans,
+    can_join,
+    drain_statistics,
+    format_batch,
+    format_codes,
+    format_joined,
+    format_str,
+    infer_target_versions,
+    join_units,
+    parse_message,
+    prepare_units,
+)
+from blackdoc.cache import StableUnits, UnitStore
+from blackdoc.classification import classify
+from blackdoc.spans import splice, unit_spans
+
+blacken = sys.modules["blackdoc.blacken"]
 
 
 @pytest.mark.parametrize(
@@ -16,3 +39,416 @@ from blackdoc.blacken import parse_message
 def test_parse_message(message, expected):
     actual = parse_message(message)
     assert expected == actual
+
+
+def test_unit_cache():
+    cache = UnitCache(maxsize=2)
+
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+
+    # "b" is now the least recently used entry
+    cache.set("c", 3)
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_format_str(monkeypatch):
+    monkeypatch.setattr(blacken, "unit_cache", UnitCache())
+    drain_statistics()
+
+    mode = black.Mode()
+    code = "import   numpy as np"
+
+    assert format_str(code, mode) == "import numpy as np\n"
+    assert format_str(code, mode) == "import numpy as np\n"
+    assert format_str(code, black.Mode(line_length=79)) == "import numpy as np\n"
+
+    assert drain_statistics() == {"unit cache hits": 1, "unit cache misses": 2}
+
+
+def test_format_str_unit_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(blacken, "unit_cache", UnitCache())
+    monkeypatch.setitem(blacken.options, "unit_store", UnitStore.open(tmp_path))
+    drain_statistics()
+
+    mode = black.Mode()
+    code = "import   numpy as np"
+
+    assert format_str(code, mode) == "import numpy as np\n"
+    # only in the persistent store
+    monkeypatch.setattr(blacken, "unit_cache", UnitCache())
+    assert format_str(code, mode) == "import numpy as np\n"
+
+    assert drain_statistics() == {
+        "unit cache misses": 2,
+        "unit store hits": 1,
+        "unit store misses": 1,
+    }
+
+
+batch_mode = black.Mode(target_versions={black.TargetVersion.PY310})
+
+
+@pytest.mark.parametrize(
+    ["codes", "expected"],
+    (
+        pytest.param(
+            ["a  = 1", "def f( x ):\n    pass", "f( a )"],
+            ["a = 1\n", "def f(x):\n    pass\n", "f(a)\n"],
+            id="statements",
+        ),
+        pytest.param(["a = 1; b = 2", "c = 3"], None, id="multiple_statements"),
+        pytest.param(["if a:", "    b = 1"], None, id="incomplete_statement"),
+        pytest.param(["a = (", "1)\nb = 2"], None, id="merged_statements"),
+        pytest.param(["a = = 1", "b = 2"], None, id="invalid"),
+    ),
+)
+def test_format_batch(codes, expected):
+    assert format_batch(codes, batch_mode) == expected
+
+
+@pytest.mark.parametrize(
+    ["codes", "expected"],
+    (
+        pytest.param(
+            [
+                "import  os\ndef f( x ):\n    pass",
+                "# comment\nf( a )",
+                "@d\nclass A: pass",
+            ],
+            [
+                "import os\n\n\ndef f(x):\n    pass\n",
+                "# comment\nf(a)\n",
+                "@d\nclass A:\n    pass\n",
+            ],
+            id="units",
+        ),
+        pytest.param(["a = (", "1)\nb = 2"], None, id="unclosed_bracket"),
+        pytest.param(['a = """', '"""'], None, id="unclosed_string"),
+        pytest.param(["a = 1 \\", "b = 2"], None, id="continuation"),
+        pytest.param(["if a:", "    b = 1"], None, id="incomplete_statement"),
+        pytest.param(["a = = 1", "b = 2"], None, id="invalid"),
+    ),
+)
+def test_format_joined(codes, expected):
+    assert format_joined(codes, batch_mode) == expected
+
+
+@pytest.mark.parametrize(
+    ["code", "mode", "expected"],
+    (
+        pytest.param("a = 1  # comment", batch_mode, True, id="comment"),
+        pytest.param("a = 1", black.Mode(), False, id="no_target_versions"),
+        pytest.param("a = 1  # fmt: skip", batch_mode, False, id="fmt"),
+        pytest.param('\n"""docstring"""', batch_mode, False, id="leading_string"),
+        pytest.param(
+            "from __future__ import annotations", batch_mode, False, id="future"
+        ),
+    ),
+)
+def test_can_join(code, mode, expected):
+    assert can_join(code, mode) is expected
+
+
+def test_join_units(monkeypatch):
+    monkeypatch.setattr(blacken, "max_joined_units", 2)
+    other_mode = black.Mode(target_versions={black.TargetVersion.PY311})
+
+    prepared = [
+        (index, "doctest", (code, mode, index, None))
+        for index, (code, mode) in enumerate(
+            [
+                ("a = 1", batch_mode),
+                ("b = 2", other_mode),
+                ("c = 3  # fmt: skip", batch_mode),
+                ("d = 4", batch_mode),
+                ("e = 5", batch_mode),
+                ("f = 6", other_mode),
+            ]
+        )
+    ]
+
+    actual = [[index for index, _, _ in batch] for batch in join_units(prepared)]
+
+    assert actual == [[2], [0, 3], [1, 5], [4]]
+
+
+def test_format_codes(monkeypatch):
+    monkeypatch.setattr(blacken, "unit_cache", UnitCache())
+    monkeypatch.setitem(blacken.options, "batch_prompts", True)
+    drain_statistics()
+
+    codes = ["a  = 1", "b = ( 2 )", "c = [\n  3]"]
+
+    actual = format_codes(codes, batch_mode, [1, 2, 3])
+
+    assert actual == ["a = 1", "b = 2", "c = [3]"]
+    assert drain_statistics() == {"unit cache misses": 3, "batched units": 3}
+
+    with pytest.raises(black.InvalidInput, match="Cannot parse.*: 12:"):
+        format_codes(["d = 4", "e = = 5"], batch_mode, [11, 12])
+
+
+@pytest.mark.parametrize(
+    "mode",
+    (
+        pytest.param(batch_mode, id="target_versions"),
+        pytest.param(black.Mode(), id="inferred_target_versions"),
+    ),
+)
+def test_blacken_spans_batch_prompts(mode, monkeypatch):
+    monkeypatch.setattr(blacken, "unit_cache", UnitCache())
+    content = textwrap.dedent(
+        '''\
+        def f():
+            """
+            >>> a  = 1
+            >>> def g( x ):
+            ...     return x
+            >>> "string"
+            >>> g( a ) # comment
+            >>> b = [
+            ...   2]
+            1
+
+            >>> c = 3
+            """
+        '''
+    )
+    labeled = tuple(classify(content))
+
+    expected = splice(content, blacken_spans(content, labeled, mode=mode))
+
+    monkeypatch.setitem(blacken.options, "batch_prompts", True)
+    actual = splice(content, blacken_spans(content, labeled, mode=mode))
+
+    assert actual == expected
+
+
+@pytest.mark.parametrize(
+    ["codes", "minimum_version"],
+    (
+        pytest.param(["a = 1", "b = 2"], black.TargetVersion.PY33, id="no_features"),
+        pytest.param(
+            ["a = 1", "match a:\n    case 1:\n        pass"],
+            black.TargetVersion.PY310,
+            id="match_statement",
+        ),
+        pytest.param(
+            ["(a := 1)", "a = = 1"], black.TargetVersion.PY38, id="invalid_unit"
+        ),
+    ),
+)
+def test_infer_target_versions(codes, minimum_version):
+    expected = {
+        version
+        for version in black.TargetVersion
+        if version.value >= minimum_version.value
+    }
+
+    assert infer_target_versions(codes) == expected
+
+
+@pytest.mark.parametrize("infer", (False, True))
+def test_prepare_units(infer, monkeypatch):
+    monkeypatch.setitem(blacken.options, "infer_target_versions", infer)
+
+    content = ">>> a = 1\n\n    >>> (b := 2)\n>>> c = 3"
+    labeled = classify(content)
+    prepared = prepare_units(unit_spans(content, labeled), mode=black.Mode())
+
+    modes = [mode for _, _, (_, mode, _, _) in prepared]
+    assert [mode.line_length for mode in modes] == [84, 80, 84]
+    # modes are shared between units with the same line length
+    assert modes[0] is modes[2]
+    if infer:
+        assert all(
+            black.TargetVersion.PY37 not in mode.target_versions for mode in modes
+        )
+        assert all(black.TargetVersion.PY38 in mode.target_versions for mode in modes)
+    else:
+        assert all(not mode.target_versions for mode in modes)
+
+
+@pytest.mark.parametrize("infer", (False, True))
+def test_prepare_units_no_features(infer, monkeypatch):
+    monkeypatch.setitem(blacken.options, "infer_target_versions", infer)
+
+    content = ">>> a = 1\n>>> b = = 2"
+    labeled = tuple(classify(content))
+    prepared = prepare_units(unit_spans(content, labeled), mode=black.Mode())
+
+    assert all(not mode.target_versions for _, _, (_, mode, _, _) in prepared)
+
+    with pytest.raises(black.InvalidInput) as e:
+        list(blacken_spans(content, labeled, mode=black.Mode()))
+
+    assert str(e.value) == "Cannot parse: 2:4: b = = 2"
+
+
+def test_format_str_stable_units(tmp_path, monkeypatch):
+    monkeypatch.setattr(blacken, "unit_cache", UnitCache())
+    monkeypatch.setitem(blacken.options, "stable_units", StableUnits.open(tmp_path))
+    drain_statistics()
+
+    mode = black.Mode()
+
+    assert format_str("a = 1", mode) == "a = 1\n"
+    assert format_str("b  = 2", mode) == "b = 2\n"
+
+    monkeypatch.setattr(blacken, "unit_cache", UnitCache())
+    original_format_str = black.format_str
+
+    def format_str_(code, mode):
+        if code == "a = 1":
+            raise AssertionError("black was called for a stable code unit")
+
+        return original_format_str(code, mode=mode)
+
+    monkeypatch.setattr(blacken.black, "format_str", format_str_)
+    assert format_str("a = 1", mode) == "a = 1\n"
+    assert format_str("b  = 2", mode) == "b = 2\n"
+
+    assert drain_statistics() == {"unit cache misses": 4, "stable units": 1}
+
+
+@pytest.mark.parametrize(
+    ["transform", "message"],
+    (
+        pytest.param(
+            lambda formatted: formatted.replace("1", "2"),
+            "not equivalent to the source",
+            id="not_equivalent",
+        ),
+        pytest.param(
+            lambda formatted: formatted.replace("=", " = "),
+            "different code on the second pass",
+            id="not_stable",
+        ),
+    ),
+)
+@pytest.mark.parametrize("safe", (False, True))
+def test_format_code_safe(safe, transform, message, monkeypatch):
+    monkeypatch.setattr(blacken, "unit_cache", UnitCache())
+    monkeypatch.setitem(blacken.options, "safe", safe)
+
+    original_format_str = black.format_str
+
+    def format_str_(code, mode):
+        formatted = original_format_str(code, mode=mode)
+        # only break the first pass
+        return transform(formatted) if code == "a=1" else formatted
+
+    monkeypatch.setattr(blacken.black, "format_str", format_str_)
+
+    if not safe:
+        assert blacken.format_code("a=1", black.Mode(), 12) == transform("a = 1")
+        return
+
+    with pytest.raises(blacken.UnsafeFormattingError, match=f": 12: .*{message}"):
+        blacken.format_code("a=1", black.Mode(), 12)
+
+    # unsafe results are not remembered
+    assert len(blacken.unit_cache) == 0
+
+
+def test_format_codes_safe(monkeypatch):
+    monkeypatch.setattr(blacken, "unit_cache", UnitCache())
+    monkeypatch.setitem(blacken.options, "batch_prompts", True)
+    monkeypatch.setitem(blacken.options, "safe", True)
+
+    original_format_str = black.format_str
+
+    def format_str_(code, mode):
+        return original_format_str(code, mode=mode).replace("2", "3")
+
+    monkeypatch.setattr(blacken.black, "format_str", format_str_)
+
+    with pytest.raises(blacken.UnsafeFormattingError, match=": 6: "):
+        format_codes(["a = 1", "b = 2", "c = 1"], batch_mode, [5, 6, 7])
+
+
+def test_format_codes_backend(monkeypatch):
+    monkeypatch.setattr(blacken, "unit_cache", UnitCache())
+    monkeypatch.setitem(blacken.options, "backend", "batched")
+    monkeypatch.setitem(blacken.format_funcs, "batched", format_black)
+
+    calls = []
+
+    def format_batch_(codes, mode):
+        calls.append(codes)
+        return [
+            (
+                black.InvalidInput(f"Cannot parse: 1:0: {code}")
+                if "= =" in code
+                else black.format_str(code, mode=mode)
+            )
+            for code in codes
+        ]
+
+    monkeypatch.setitem(blacken.batch_funcs, "batched", format_batch_)
+
+    mode = black.Mode()
+    actual = format_codes(["a=1", "b=2", "a=1"], mode, [1, 2, 3])
+    assert actual == ["a = 1", "b = 2", "a = 1"]
+    assert calls == [["a=1", "b=2"]]
+
+    with pytest.raises(black.InvalidInput, match=": 5:0: c = = 3"):
+        format_codes(["a=1", "c = = 3", "d=4"], mode, [4, 5, 6])
+    assert calls[1:] == [["c = = 3", "d=4"]]
+
+
+def test_format_codes_batch_units(monkeypatch):
+    monkeypatch.setattr(blacken, "unit_cache", UnitCache())
+    monkeypatch.setitem(blacken.options, "batch_units", True)
+    drain_statistics()
+
+    codes = ["a  = 1", "def f( x ):\n  pass", "a  = 1"]
+
+    actual = format_codes(codes, batch_mode, [1, 2, 5])
+
+    assert actual == ["a = 1", "def f(x):\n    pass", "a = 1"]
+    assert drain_statistics() == {"unit cache misses": 2, "batched units": 2}
+
+    with pytest.raises(black.InvalidInput, match="Cannot parse.*: 12:"):
+        format_codes(["b = 2", "c = [\n  3,,]", "d  = 4"], batch_mode, [10, 11, 13])
+
+
+@pytest.mark.parametrize(
+    ["content", "expected"],
+    (
+        pytest.param(
+            ">>> a = = 1\n\n>>> b = = 2  # fmt: skip\n\n>>> c = 3\n",
+            ": 1:4: ",
+            id="batched",
+        ),
+        pytest.param(
+            ">>> a = 1\n\n>>> b = = 2  # fmt: skip\n\n>>> c = = 3\n",
+            ": 3:4: ",
+            id="single",
+        ),
+    ),
+)
+@pytest.mark.parametrize("option", ("batch_units", "backend"))
+def test_blacken_spans_first_error(option, content, expected, monkeypatch):
+    monkeypatch.setattr(blacken, "unit_cache", UnitCache())
+    if option == "backend":
+        monkeypatch.setitem(blacken.options, "backend", "batched")
+        monkeypatch.setitem(blacken.format_funcs, "batched", format_black)
+        monkeypatch.setitem(
+            blacken.batch_funcs,
+            "batched",
+            lambda codes, mode: [black.format_str(code, mode=mode) for code in codes],
+        )
+    else:
+        monkeypatch.setitem(blacken.options, option, True)
+
+    # the first and the last unit are batched, the second can't be batched
+    labeled = tuple(classify(content))
+
+    with pytest.raises(black.InvalidInput, match=expected):
+        tuple(blacken_spans(content, labeled, mode=batch_mode))
@@ -0,0 +1,105 @@
+import os
+
+import black
+import pytest
+
+from blackdoc import cache
+
+
+def test_get_cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("BLACKDOC_CACHE_DIR", str(tmp_path / "env"))
+
+    assert cache.get_cache_dir() == tmp_path / "env"
+    assert cache.get_cache_dir(tmp_path / "explicit") == tmp_path / "explicit"
+
+
+@pytest.mark.parametrize(
+    ["mode1", "mode2", "options", "equal"],
+    (
+        pytest.param(black.Mode(), black.Mode(), {}, True, id="identical"),
+        pytest.param(
+            black.Mode(), black.Mode(line_length=79), {}, False, id="line_length"
+        ),
+        pytest.param(black.Mode(), black.Mode(), {"option": True}, False, id="options"),
+    ),
+)
+def test_cache_key(mode1, mode2, options, equal):
+    assert (cache.cache_key(mode1) == cache.cache_key(mode2, **options)) is equal
+
+
+def test_cache(tmp_path):
+    cache_dir = tmp_path / "cache"
+    key = cache.cache_key(black.Mode())
+
+    path1 = tmp_path / "file1.py"
+    path1.write_text(">>> a = 1\n")
+    path2 = tmp_path / "file2.py"
+    path2.write_text(">>> b = 2\n")
+
+    cache_ = cache.Cache.read(key, cache_dir)
+    assert cache_.filtered_cached({path1, path2}) == ({path1, path2}, set())
+
+    cache_.write([path1, path2])
+
+    cache_ = cache.Cache.read(key, cache_dir)
+    assert cache_.filtered_cached({path1, path2}) == (set(), {path1, path2})
+
+    # modified content
+    path1.write_text(">>> a = 10\n")
+    # same content, but newer modification time
+    stat = path2.stat()
+    os.utime(path2, (stat.st_atime, stat.st_mtime + 10))
+
+    assert cache_.filtered_cached({path1, path2}) == ({path1}, {path2})
+
+    # different key
+    other = cache.Cache.read(cache.cache_key(black.Mode(line_length=79)), cache_dir)
+    assert other.filtered_cached({path1, path2}) == ({path1, path2}, set())
+
+
+def test_unit_store(tmp_path):
+    mode = black.Mode()
+    store = cache.UnitStore.open(tmp_path, max_entries=2)
+
+    assert store.get("a=1", mode) is None
+    store.set("a=1", mode, "a = 1\n")
+    assert store.get("a=1", mode) == "a = 1\n"
+    assert store.get("a=1", black.Mode(line_length=79)) is None
+    store.close()
+
+    # shared between runs
+    store = cache.UnitStore.open(tmp_path, max_entries=2)
+    assert store.get("a=1", mode) == "a = 1\n"
+
+    store.set("b=2", mode, "b = 2\n")
+    store.set("c=3", mode, "c = 3\n")
+    # update the last use of "a=1"
+    assert store.get("a=1", mode) == "a = 1\n"
+    store.evict()
+
+    assert store.get("b=2", mode) is None
+    assert store.get("a=1", mode) == "a = 1\n"
+    assert store.get("c=3", mode) == "c = 3\n"
+    store.close()
+
+
+def test_stable_units(tmp_path, monkeypatch):
+    mode = black.Mode()
+    stable = cache.StableUnits.open(tmp_path)
+
+    assert ("a = 1", mode) not in stable
+    stable.add("a = 1", mode)
+    assert ("a = 1", mode) in stable
+    assert ("a = 1", black.Mode(line_length=79)) not in stable
+    stable.close()
+
+    # shared between runs
+    stable = cache.StableUnits.open(tmp_path)
+    assert ("a = 1", mode) in stable
+    stable.close()
+
+    # invalidated by a different version of black
+    monkeypatch.setattr(black, "__version__", "0.0.0")
+    stable = cache.StableUnits.open(tmp_path)
+    assert ("a = 1", mode) not in stable
+    stable.close()
@@ -1,3 +1,5 @@
+import textwrap
+
 import pytest
 
 from blackdoc import classification, formats
@@ -22,3 +24,205 @@ def test_detect_format(format, monkeypatch):
     print_classification(actual)
 
     assert expected == actual
+
+
+def test_build_dispatcher(monkeypatch):
+    def custom(lines):
+        return None
+
+    funcs = (
+        ("none", formats.none.detection_func),
+        ("doctest", formats.doctest.detection_func),
+        ("rst", formats.rst.detection_func),
+        ("custom", custom),
+    )
+    table, unrestricted = classification.build_dispatcher(funcs)
+
+    assert unrestricted == (("custom", custom),)
+    assert table == {
+        ">": (("doctest", formats.doctest.detection_func), ("custom", custom)),
+        ".": (("rst", formats.rst.detection_func), ("custom", custom)),
+        ":": (("rst", formats.rst.detection_func), ("custom", custom)),
+    }
+
+
+def test_detect_format_adjacent_units():
+    lines = [">>> a", ".. code:: python", "", "   x=1"]
+    expected = (
+        ((1, 2), "doctest", ">>> a"),
+        ((2, 5), "rst", ".. code:: python\n\n   x=1"),
+    )
+
+    actual = tuple(classification.detect_format(enumerate(lines, start=1)))
+
+    assert actual == expected
+
+
+def test_detect_format_coalesces_unformatted_lines():
+    lines = ["a", "", "b", ">>> a", "c", "d"]
+    expected = (
+        ((1, 4), "none", "a\n\nb"),
+        ((4, 5), "doctest", ">>> a"),
+        ((5, 7), "none", "c\nd"),
+    )
+
+    actual = tuple(classification.detect_format(enumerate(lines, start=1)))
+
+    assert actual == expected
+
+
+def test_detect_format_path():
+    lines = ["```python", "x=1", "```"]
+    numbered = list(enumerate(lines, start=1))
+
+    assert tuple(classification.detect_format(numbered, path="a.md")) == (
+        ((1, 4), "markdown", "\n".join(lines)),
+    )
+    assert tuple(classification.detect_format(numbered, path="a.rst")) == (
+        ((1, 4), "none", "\n".join(lines)),
+    )
+
+
+def test_candidate_lines(monkeypatch):
+    content = "a\n  >>> b\n\t.. c\nd >>> e\n>>> f"
+
+    assert list(classification.candidate_lines(content)) == [2, 3, 5]
+
+    # formats without leading characters can start on any line
+    leading_characters = dict(classification.leading_characters)
+    del leading_characters["doctest"]
+    monkeypatch.setattr(classification, "leading_characters", leading_characters)
+    monkeypatch.setattr(
+        classification, "build_dispatcher", classification.build_dispatcher.__wrapped__
+    )
+    classification.candidate_pattern.cache_clear()
+    try:
+        assert classification.candidate_lines(content) is None
+    finally:
+        classification.candidate_pattern.cache_clear()
+
+
+@pytest.mark.parametrize("format", ("rst", "doctest", "ipython"))
+def test_detect_format_candidates(format):
+    lines = ["text", ""] + getattr(data, format).lines + ["", "text"]
+    content = "\n".join(lines)
+
+    candidates = classification.candidate_lines(content)
+    actual = tuple(
+        classification.detect_format(enumerate(lines, start=1), candidates=candidates)
+    )
+    expected = tuple(classification.detect_format(enumerate(lines, start=1)))
+
+    assert actual == expected
+
+
+@pytest.mark.parametrize(
+    ["lines", "expected"],
+    (
+        pytest.param(["a", "", "b", "c", "", "d"], [2, 5], id="blank_lines"),
+        pytest.param(["a", "", "   b", "", "c"], [4], id="indented"),
+        pytest.param(["```python", "", "a", "```", "", "b"], [5], id="fence"),
+        pytest.param([":::{note}", "", "a", "", ":::", "", "b"], [6], id="colon_fence"),
+        pytest.param(["````", "```", "", "a", "````", "", "b"], [6], id="nested_fence"),
+        pytest.param(["```", "", "a"], [], id="unclosed_fence"),
+        pytest.param([".. code::", "", "@decorator", "def f():"], [], id="decorator"),
+    ),
+)
+def test_split_points(lines, expected):
+    assert list(classification.split_points(lines)) == expected
+
+
+def test_split_lines():
+    lines = ["a", "", "b", "", "c", "", "d", "", "e", "f"]
+
+    assert list(classification.split_lines(lines, 3)) == [(0, 4), (4, 10)]
+    assert list(classification.split_lines(lines, 100)) == [(0, 10)]
+
+
+def test_classify_first_line_number():
+    content = "a\n>>> b\n"
+
+    actual = tuple(classification.classify(content, first_line_number=10))
+
+    assert actual == (
+        ((10, 11), "none", "a"),
+        ((11, 12), "doctest", ">>> b"),
+        ((12, 13), "none", ""),
+    )
+
+
+def test_string_line_ranges():
+    content = textwrap.dedent(
+        '''\
+        def f():
+            """docstring
+
+            >>> f()
+            """
+            return "a"
+        '''
+    )
+
+    assert classification.string_line_ranges(content) == [(2, 7)]
+    assert classification.string_line_ranges('"""unclosed\n') is None
+
+
+@pytest.mark.parametrize("strings_only", (False, True))
+def test_classify_strings_only(strings_only, monkeypatch):
+    monkeypatch.setitem(classification.options, "strings_only", strings_only)
+
+    content = textwrap.dedent(
+        '''\
+        def f():
+            """
+            >>> f()
+            """
+        >>> f()
+        '''
+    )
+
+    actual = tuple(
+        code_format
+        for _, code_format, _ in classification.classify(content, path="a.py")
+    )
+    if strings_only:
+        expected = ("none", "doctest", "none")
+    else:
+        expected = ("none", "doctest", "none", "doctest", "none")
+
+    assert actual == expected
+
+
+@pytest.mark.parametrize(
+    ["lines", "expected"],
+    (
+        pytest.param(
+            ["```console", "$ ls", "```", ">>> b"],
+            (((1, 4), "none", "```console\n$ ls\n```"), ((4, 5), "doctest", ">>> b")),
+            id="pass_through",
+        ),
+        pytest.param(
+            ["```pycon", ">>> a", "```", ">>> b"],
+            (
+                ((1, 2), "none", "```pycon"),
+                ((2, 3), "doctest", ">>> a"),
+                ((3, 4), "none", "```"),
+                ((4, 5), "doctest", ">>> b"),
+            ),
+            id="prompts",
+        ),
+        pytest.param(
+            ["```{eval-rst}", ".. code:: python", "", "    a = 1", "```"],
+            (
+                ((1, 2), "none", "```{eval-rst}"),
+                ((2, 5), "rst", ".. code:: python\n\n    a = 1"),
+                ((5, 6), "none", "```"),
+            ),
+            id="rst_directive",
+        ),
+    ),
+)
+def test_detect_format_foreign_code_block(lines, expected):
+    actual = tuple(classification.detect_format(enumerate(lines, start=1)))
+
+    assert actual == expected
@@ -1,10 +1,17 @@
+import argparse
 import textwrap
 from dataclasses import dataclass
 
 import black
 import pytest
 
-from blackdoc.__main__ import format_and_check, format_and_overwrite
+from blackdoc import concurrency, formats
+from blackdoc.__main__ import (
+    check_format_patterns,
+    format_and_check,
+    format_and_overwrite,
+    process,
+)
 
 
 @dataclass
@@ -76,3 +83,54 @@ def test_format_and_check(sample_code, tmp_path, capsys):
     assert result == sample_code.result
     assert data_path.read_text() == sample_code.unformatted
     assert stdout != ""
+
+
+def test_check_format_patterns():
+    assert check_format_patterns(r"markdown=\.(md|txt)$,rst=\.r{1,2}st$") == {
+        "markdown": r"\.(md|txt)$",
+        "rst": r"\.r{1,2}st$",
+    }
+    assert check_format_patterns("rst=") == {"rst": ""}
+
+    with pytest.raises(argparse.ArgumentTypeError):
+        check_format_patterns("unknown=abc")
+    with pytest.raises(argparse.ArgumentTypeError):
+        check_format_patterns("rst")
+
+
+@pytest.mark.parametrize("workers", (1, 2))
+def test_process_schedule_chunks_invalid_format(tmp_path, workers, monkeypatch, capsys):
+    monkeypatch.setattr(concurrency, "chunk_size", 2)
+    tmp_path.joinpath("a.md").write_text(
+        "text\n\n```python\na=1\n```\n\npara\n\n```python\nb=2\n"
+    )
+    tmp_path.joinpath("b.md").write_text("```python\na=1\n```\n")
+
+    def run(schedule):
+        args = argparse.Namespace(
+            src=[tmp_path],
+            action="check",
+            diff=None,
+            color=False,
+            include=formats.format_include_patterns(),
+            exclude="",
+            extend_exclude="",
+            line_length=88,
+            skip_string_normalization=False,
+            quiet=False,
+            verbose=False,
+            cache=False,
+            schedule=schedule,
+            workers=workers,
+        )
+        return_code = process(args)
+
+        return return_code, capsys.readouterr().err
+
+    expected_code, expected_err = run("files")
+    actual_code, actual_err = run("chunks")
+
+    assert expected_code == 123
+    assert "without closing fence" in " ".join(expected_err.split())
+    assert actual_code == expected_code
+    assert actual_err == expected_err
@@ -0,0 +1,227 @@
+import io
+import re
+import sys
+import textwrap
+
+import black
+import pytest
+
+from blackdoc import cache, concurrency
+from blackdoc.__main__ import (
+    check,
+    format_and_check,
+    format_and_overwrite,
+    overwrite,
+    report_error,
+)
+
+unformatted = textwrap.dedent(
+    """\
+    >>> def f(a:int=None)->str :
+    ...     return  'b'
+    """
+)
+formatted = textwrap.dedent(
+    """\
+    >>> def f(a: int = None) -> str:
+    ...     return "b"
+    """
+)
+invalid = ">>> f(\n"
+contents = {
+    "a.py": unformatted,
+    "b.py": formatted,
+    "c.py": invalid,
+    "d.py": unformatted,
+    # large enough to be split into chunks
+    "e.py": "\n".join([unformatted, formatted, unformatted] * 3),
+    "f.py": "\n".join([unformatted, formatted, invalid, unformatted]),
+}
+
+
+def strip_timestamps(diff):
+    # the diff headers contain the modification time
+    return re.sub(r"\d{4}-\d{2}-\d{2} [0-9:.]+\+00:00 \+0000", "", diff)
+
+
+def write_sources(root):
+    for name, content in contents.items():
+        root.joinpath(name).write_text(content)
+
+    return [root / name for name in contents]
+
+
+@pytest.mark.parametrize(
+    ["action", "kwargs"],
+    (
+        pytest.param(format_and_overwrite, {}, id="inplace"),
+        pytest.param(format_and_check, {"diff": True, "color": False}, id="check"),
+    ),
+)
+def test_process_sources(tmp_path, action, kwargs, capsys):
+    mode = black.Mode()
+
+    sources = write_sources(tmp_path)
+    serial = concurrency.process_sources(action, sources, mode, kwargs, workers=1)
+    serial_output = capsys.readouterr()
+
+    write_sources(tmp_path)
+    parallel = concurrency.process_sources(action, sources, mode, kwargs, workers=2)
+    parallel_output = capsys.readouterr()
+
+    assert parallel == serial
+    assert list(parallel) == sorted(sources)
+    assert parallel_output.err == serial_output.err
+    assert strip_timestamps(parallel_output.out) == strip_timestamps(serial_output.out)
+
+
+def test_process_sources_merged_output(tmp_path, monkeypatch):
+    mode = black.Mode()
+    kwargs = {"diff": True, "color": False}
+    sources = write_sources(tmp_path)
+
+    def run(workers):
+        write_sources(tmp_path)
+
+        # both streams write to the same terminal or pipe
+        merged = io.StringIO()
+        monkeypatch.setattr(sys, "stdout", merged)
+        monkeypatch.setattr(sys, "stderr", merged)
+        concurrency.process_sources(
+            format_and_check, sources, mode, kwargs, workers=workers
+        )
+
+        return strip_timestamps(merged.getvalue())
+
+    assert run(workers=2) == run(workers=1)
+
+
+@pytest.mark.parametrize("schedule", ("units", "chunks"))
+@pytest.mark.parametrize("workers", (1, 2))
+@pytest.mark.parametrize(
+    ["action", "finish", "kwargs"],
+    (
+        pytest.param(format_and_overwrite, overwrite, {}, id="inplace"),
+        pytest.param(
+            format_and_check, check, {"diff": True, "color": False}, id="check"
+        ),
+    ),
+)
+def test_schedule(
+    tmp_path, action, finish, kwargs, workers, schedule, capsys, monkeypatch
+):
+    monkeypatch.setattr(concurrency, "chunk_size", 2)
+    schedule_func = getattr(concurrency, f"schedule_{schedule}")
+    mode = black.Mode()
+
+    sources = write_sources(tmp_path)
+    expected = concurrency.process_sources(action, sources, mode, kwargs)
+    expected_output = capsys.readouterr()
+    expected_contents = {path: path.read_text() for path in sources}
+
+    write_sources(tmp_path)
+    actual = schedule_func(finish, report_error, sources, mode, kwargs, workers=workers)
+    actual_output = capsys.readouterr()
+    actual_contents = {path: path.read_text() for path in sources}
+
+    assert actual == expected
+    assert actual_contents == expected_contents
+    assert actual_output.err == expected_output.err
+    assert strip_timestamps(actual_output.out) == strip_timestamps(expected_output.out)
+
+
+def test_initialize_worker(tmp_path, monkeypatch):
+    detection_funcs = dict(concurrency.formats.detection_funcs)
+    monkeypatch.setattr(
+        concurrency.formats.register, "detection_funcs", detection_funcs
+    )
+    monkeypatch.setattr(concurrency.formats, "detection_funcs", detection_funcs)
+
+    detection_patterns = {}
+    monkeypatch.setattr(concurrency.formats, "detection_patterns", detection_patterns)
+
+    options = {"unit_store": None}
+    monkeypatch.setattr(concurrency, "options", options)
+
+    store = cache.UnitStore(tmp_path / "units.sqlite")
+    concurrency.initialize_worker(
+        {
+            "formats": ("none", "doctest"),
+            "options": {"unit_store": store},
+            "detection_patterns": {"doctest": r"\.py$"},
+        }
+    )
+
+    assert set(detection_funcs) == {"none", "doctest"}
+    assert options["unit_store"] is store
+    assert detection_patterns == {"doctest": r"\.py$"}
+
+
+def test_submit_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(concurrency, "chunk_size", 5)
+
+    path = tmp_path / "e.py"
+    path.write_text(contents["e.py"])
+
+    job = concurrency.submit_chunks(concurrency.SerialExecutor(), path, black.Mode())
+
+    assert job.n_pending == 4
+    assert concurrency.collect_chunks(job) == "\n".join([formatted] * 9)
+
+
+@pytest.mark.parametrize(
+    ["content", "expected"],
+    (
+        pytest.param(
+            ">>> a = = 1\n\n>>> b = = 2  # fmt: skip\n\n>>> c = 3\n",
+            ": 1:4: a = = 1",
+            id="batched",
+        ),
+        pytest.param(
+            ">>> a = 1\n\n>>> b = = 2  # fmt: skip\n\n>>> c = = 3\n",
+            ": 3:4: b = = 2",
+            id="single",
+        ),
+    ),
+)
+@pytest.mark.parametrize("workers", (1, 2))
+def test_schedule_units_first_error(
+    tmp_path, workers, content, expected, monkeypatch, capsys
+):
+    monkeypatch.setitem(concurrency.options, "batch_units", True)
+    mode = black.Mode(target_versions={black.TargetVersion.PY310})
+
+    # the first and the last unit are batched, the second can't be batched
+    path = tmp_path / "a.py"
+    path.write_text(content)
+
+    actual = concurrency.schedule_units(
+        overwrite, report_error, [path], mode, {}, workers=workers
+    )
+    # the messages are wrapped at the width of the terminal
+    err = " ".join(capsys.readouterr().err.split())
+
+    assert actual == {path: "error"}
+    assert expected in err
+
+
+@pytest.mark.parametrize("workers", (1, 2))
+def test_schedule_units_batch_prompts(tmp_path, workers, monkeypatch, capsys):
+    mode = black.Mode(target_versions={black.TargetVersion.PY310})
+    prompts = ">>> a  = 1\n>>> b = ( 2 )\n>>> c = = 3\n>>> d =[ 4 ]\n"
+
+    path = tmp_path / "a.py"
+    path.write_text(prompts.replace(">>> c = = 3\n", ""))
+    invalid = tmp_path / "b.py"
+    invalid.write_text(prompts)
+
+    monkeypatch.setitem(concurrency.options, "batch_prompts", True)
+    actual = concurrency.schedule_units(
+        overwrite, report_error, [path, invalid], mode, {}, workers=workers
+    )
+    # the messages are wrapped at the width of the terminal
+    err = " ".join(capsys.readouterr().err.split())
+
+    assert actual == {path: "reformatted", invalid: "error"}
+    assert path.read_text() == ">>> a = 1\n>>> b = 2\n>>> d = [4]\n"
+    assert "Cannot parse" in err and ": 3:" in err
@@ -0,0 +1,76 @@
+import pytest
+
+from blackdoc.formats import InvalidFormatError
+from blackdoc.formats.cursor import LineCursor, PeekableLines, adapt_detection_func
+
+lines = ["a", "b", "c"]
+
+
+def test_line_cursor():
+    cursor = LineCursor(lines, first_line_number=3)
+
+    assert cursor
+    assert cursor.line_number == 3
+    assert cursor.peek() == "a"
+    assert cursor.peek(2) == "c"
+    assert cursor.peek(3) is None
+
+    mark = cursor.mark()
+    cursor.advance(2)
+    assert cursor.line_number == 5
+    assert cursor.unit("none", mark) == ((3, 5), "none", "a\nb")
+
+    cursor.reset(mark)
+    cursor.skip_while(lambda line: line != "c")
+    assert cursor.peek() == "c"
+
+    cursor.advance(5)
+    assert not cursor
+    assert cursor.peek() is None
+
+
+def test_line_cursor_from_numbered():
+    cursor = LineCursor.from_numbered(enumerate(lines, start=2))
+
+    assert cursor.lines == lines
+    assert cursor.line_number == 2
+
+    with pytest.raises(InvalidFormatError, match="not contiguous"):
+        LineCursor.from_numbered([(1, "a"), (3, "b")])
+
+
+def test_peekable_lines():
+    cursor = LineCursor(lines)
+    peekable = PeekableLines(cursor)
+
+    assert peekable.peek() == (1, "a")
+    assert next(peekable) == (1, "a")
+    assert next(peekable) == (2, "b")
+
+    peekable.prepend((1, "a"), (2, "b"))
+    assert cursor.line_number == 1
+
+    with pytest.raises(ValueError):
+        peekable.prepend((0, "x"))
+
+    assert list(peekable) == [(1, "a"), (2, "b"), (3, "c")]
+    assert not peekable
+    assert peekable.peek(None) is None
+    with pytest.raises(StopIteration):
+        peekable.peek()
+
+
+def test_adapt_detection_func():
+    def detection_func(lines):
+        taken = [next(lines), next(lines)]
+        if taken[1][1] != "b":
+            lines.prepend(*taken)
+            return None
+
+        return (1, 3), "custom", "a\nb"
+
+    wrapped = adapt_detection_func(detection_func)
+    cursor = LineCursor(lines)
+
+    assert wrapped(cursor) == ((1, 3), "custom", "a\nb")
+    assert cursor.line_number == 3
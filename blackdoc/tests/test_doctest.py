@@ -5,6 +5,7 @@ import pytest
 
 from blackdoc import blacken
 from blackdoc.formats import doctest
+from blackdoc.formats.cursor import LineCursor
 from blackdoc.tests.data import doctest as data
 
 
@@ -109,7 +110,7 @@ def test_detection_func(string, expected):
         return range_, label, string
 
     lines = string.split("\n")
-    lines_ = more_itertools.peekable(enumerate(lines, start=1))
+    lines_ = LineCursor(lines)
 
     actual = doctest.detection_func(lines_)
     assert actual == construct_expected(expected, string.rstrip())
@@ -507,6 +508,59 @@ def test_reformatting_func(code_unit, docstring_quotes, expected):
     assert expected_quotes == actual_quotes
 
 
+@pytest.mark.parametrize(
+    ["code_unit", "original_quotes", "expected"],
+    (
+        pytest.param("a = 1", None, [["a = 1"]], id="single_line"),
+        pytest.param("a = 1\nb = 2", None, [["a = 1"], ["b = 2"]], id="two_statements"),
+        pytest.param(
+            "a = [\n    1,\n]", None, [["a = [", "    1,", "]"]], id="closing_bracket"
+        ),
+        pytest.param(
+            "# comment\na = 1\n# comment\nb = 2",
+            None,
+            [["# comment", "a = 1", "# comment"], ["b = 2"]],
+            id="comments",
+        ),
+        pytest.param(
+            "@decorator\ndef f():\n    pass",
+            None,
+            [["@decorator", "def f():", "    pass"]],
+            id="decorator",
+        ),
+        pytest.param(
+            "try:\n    pass\nexcept ValueError:\n    pass\nfinally:\n    pass",
+            None,
+            [
+                [
+                    "try:",
+                    "    pass",
+                    "except ValueError:",
+                    "    pass",
+                    "finally:",
+                    "    pass",
+                ]
+            ],
+            id="compound_statement",
+        ),
+        pytest.param(
+            'a = """\nb = 2\n"""',
+            None,
+            [['a = """', "b = 2", '"""']],
+            id="multi_line_string",
+        ),
+        pytest.param(
+            'def f():\n    """docstring"""\n\n\nf()',
+            "'''",
+            [["def f():", "    '''docstring'''", "", ""], ["f()"]],
+            id="restore_quotes",
+        ),
+    ),
+)
+def test_split_by_statement(code_unit, original_quotes, expected):
+    assert doctest.split_by_statement(code_unit, original_quotes) == expected
+
+
 def test_blacken():
     labeled = tuple(
         ((min_ + 1, max_ + 1), label, "\n".join(data.lines[slice(min_, max_)]))
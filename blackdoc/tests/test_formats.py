@@ -0,0 +1,87 @@
+import types
+
+import pytest
+
+from blackdoc.formats import register
+from blackdoc.formats.cursor import LineCursor
+
+
+@pytest.mark.parametrize(
+    ["data", "expected"],
+    (
+        pytest.param(b"plain text\nwithout code\n", False, id="text"),
+        pytest.param(b"def f():\n    return 1\n", False, id="code"),
+        pytest.param(b'"""\n>>> f()\n1\n"""\n', True, id="doctest"),
+        pytest.param(b"In [1]: f()\n", True, id="ipython"),
+        pytest.param(b".. code:: python\n\n    f()\n", True, id="rst"),
+        pytest.param(b"```python\nf()\n```\n", True, id="markdown"),
+    ),
+)
+def test_may_contain_code(data, expected):
+    assert register.may_contain_code(data) is expected
+
+
+def test_may_contain_code_unknown_markers(monkeypatch):
+    detection_funcs = dict(register.detection_funcs)
+    detection_funcs["custom"] = lambda lines: None
+    monkeypatch.setattr(register, "detection_funcs", detection_funcs)
+
+    assert register.detection_markers() is None
+    assert register.may_contain_code(b"plain text\n")
+
+
+def test_may_contain_code_disabled_formats(monkeypatch):
+    detection_funcs = {
+        name: func
+        for name, func in register.detection_funcs.items()
+        if name in ("none", "rst")
+    }
+    monkeypatch.setattr(register, "detection_funcs", detection_funcs)
+
+    assert register.detection_markers() == (b"::",)
+    assert not register.may_contain_code(b">>> f()\n")
+
+
+def test_register_format_peekable(monkeypatch):
+    def detection_func(lines):
+        line_number, line = lines.peek()
+        if line != "custom":
+            return None
+
+        next(lines)
+        return (line_number, line_number + 1), "custom", line
+
+    module = types.SimpleNamespace(
+        detection_func=detection_func,
+        extraction_func=lambda line: ({}, line),
+        reformatting_func=lambda line: line,
+    )
+
+    for attr in ("detection_funcs", "extraction_funcs", "reformatting_funcs"):
+        monkeypatch.setattr(register, attr, {})
+    register.register_format("custom", module)
+
+    cursor = LineCursor(["custom", "other"])
+    actual = register.detection_funcs["custom"](cursor)
+
+    assert actual == ((1, 2), "custom", "custom")
+    assert cursor.line_number == 2
+
+
+@pytest.mark.parametrize(
+    ["path", "expected"],
+    (
+        pytest.param(
+            "a.py", {"none", "doctest", "ipython", "rst", "markdown"}, id="py"
+        ),
+        pytest.param("a.rst", {"none", "doctest", "ipython", "rst"}, id="rst"),
+        pytest.param(
+            "a.md", {"none", "doctest", "ipython", "rst", "markdown"}, id="md"
+        ),
+        pytest.param(
+            "a.txt", {"none", "doctest", "ipython", "rst", "markdown"}, id="unknown"
+        ),
+    ),
+)
+def test_formats_for(path, expected):
+    assert set(register.formats_for(path)) == expected
@@ -5,6 +5,7 @@ import pytest
 
 from blackdoc import blacken
 from blackdoc.formats import ipython
+from blackdoc.formats.cursor import LineCursor
 from blackdoc.tests.data import ipython as data
 
 
@@ -41,9 +42,7 @@ from blackdoc.tests.data import ipython as data
     ),
 )
 def test_detection_func(lines, expected):
-    lines = more_itertools.peekable(
-        enumerate(more_itertools.always_iterable(lines), start=1)
-    )
+    lines = LineCursor(list(more_itertools.always_iterable(lines)))
 
     actual = ipython.detection_func(lines)
     assert actual == expected
@@ -1,9 +1,9 @@
 import textwrap
 
-import more_itertools
 import pytest
 
-from blackdoc.formats import markdown
+from blackdoc.formats import InvalidFormatError, markdown
+from blackdoc.formats.cursor import LineCursor
 
 
 @pytest.mark.parametrize(
@@ -30,9 +30,67 @@ from blackdoc.formats import markdown
                 ```
                 """
             ),
-            None,
+            "none",
             id="code_other_language",
         ),
+        pytest.param(
+            textwrap.dedent(
+                """\
+                ````markdown
+                ```python
+                >>> 10 * 5
+                ```
+                ````
+                """
+            ),
+            None,
+            id="code_other_language-nested",
+        ),
+        pytest.param(
+            textwrap.dedent(
+                """\
+                ```pycon
+                >>> a = 1
+                ```
+                """
+            ),
+            None,
+            id="code_other_language-prompt",
+        ),
+        pytest.param(
+            textwrap.dedent(
+                """\
+                ```{eval-rst}
+                .. code-block:: python
+
+                    a = 1
+                ```
+                """
+            ),
+            None,
+            id="code_other_language-rst_directive",
+        ),
+        pytest.param(
+            textwrap.dedent(
+                """\
+                ```sh
+                find . -name "*.py"
+                """
+            ),
+            None,
+            id="code_other_language-unclosed",
+        ),
+        pytest.param(
+            textwrap.dedent(
+                """\
+                :::{note}
+                >>> 10 * 5
+                :::
+                """
+            ),
+            None,
+            id="myst-other_directive",
+        ),
         pytest.param(
             textwrap.dedent(
                 """\
@@ -194,11 +252,11 @@ def test_detection_func(string, expected):
 
         n_lines = len(string.split("\n"))
 
-        range_ = (1, n_lines + 2)
+        range_ = (1, n_lines + 1)
         return range_, label, string
 
     lines = string.split("\n")
-    code_fragment = more_itertools.peekable(enumerate(lines, start=1))
+    code_fragment = LineCursor(lines)
     actual = markdown.detection_func(code_fragment)
 
     assert actual == construct_expected(expected, string.rstrip())
@@ -695,3 +753,47 @@ def test_reformatting_func(code, directive, expected):
     actual = markdown.reformatting_func(code, **directive)
 
     assert expected == actual
+
+
+def test_fence_index():
+    lines = textwrap.dedent(
+        """\
+        ```python
+        ---
+        a: 1
+        ---
+        10 * 5
+        ```
+        ````markdown
+        ```python
+        ```
+        ````
+        :::{python}
+        :::
+        """
+    ).split("\n")
+
+    index = markdown.FenceIndex(lines)
+
+    assert index.blocks == {0: (5, 4, True), 6: (9, None, False), 10: (11, 11, True)}
+
+
+def test_fence_index_unclosed():
+    lines = ["```python", "10 * 5", "", ":::python", "```bash", "ls"]
+
+    with pytest.raises(InvalidFormatError, match="starting at lines 1, 4"):
+        markdown.FenceIndex(lines)
+
+
+def test_detection_func_cached_index():
+    lines = LineCursor(["```python", "10 * 5", "```", "```python", "1", "```"])
+
+    assert markdown.detection_func(lines) == (
+        (1, 4),
+        "markdown",
+        "```python\n10 * 5\n```",
+    )
+    index = lines.cache["markdown"]
+
+    assert markdown.detection_func(lines) == ((4, 7), "markdown", "```python\n1\n```")
+    assert lines.cache["markdown"] is index
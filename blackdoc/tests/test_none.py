@@ -1,4 +1,5 @@
 from blackdoc.formats import none
+from blackdoc.formats.cursor import LineCursor
 from blackdoc.tests.data.doctest import lines
 
 
@@ -7,7 +8,7 @@ def test_detection_func():
     line = lines[0]
     name = none.name
 
-    assert none.detection_func(enumerate(lines, start=1)) == (line_range, name, line)
+    assert none.detection_func(LineCursor(lines)) == (line_range, name, line)
 
 
 def test_extraction_func():
@@ -1,10 +1,10 @@
 import textwrap
 
-import more_itertools
 import pytest
 
 from blackdoc import blacken
 from blackdoc.formats import rst
+from blackdoc.formats.cursor import LineCursor
 from blackdoc.tests.data import rst as data
 
 
@@ -21,9 +21,33 @@ from blackdoc.tests.data import rst as data
                     This is not a code block.
                 """
             ),
-            None,
+            "none",
             id="block",
         ),
+        pytest.param(
+            textwrap.dedent(
+                """\
+                .. note::
+
+                    >>> 10 * 5
+                """
+            ),
+            None,
+            id="block-with_prompt",
+        ),
+        pytest.param(
+            textwrap.dedent(
+                """\
+                .. note::
+
+                    .. code:: python
+
+                        10 * 5
+                """
+            ),
+            None,
+            id="block-with_directive",
+        ),
         pytest.param(
             textwrap.dedent(
                 """\
@@ -32,9 +56,20 @@ from blackdoc.tests.data import rst as data
                     find . -name "*.py"
                 """
             ),
-            None,
+            "none",
             id="code_other_language",
         ),
+        pytest.param(
+            textwrap.dedent(
+                """\
+                ::
+
+                    10 * 5
+                """
+            ),
+            "none",
+            id="literal_block",
+        ),
         pytest.param(
             textwrap.dedent(
                 """\
@@ -155,7 +190,7 @@ def test_detection_func(string, expected):
         return range_, label, string
 
     lines = string.split("\n")
-    code_fragment = more_itertools.peekable(enumerate(lines, start=1))
+    code_fragment = LineCursor(lines)
     actual = rst.detection_func(code_fragment)
 
     assert actual == construct_expected(expected, string.rstrip())
@@ -363,3 +398,54 @@ def test_blacken():
     actual = tuple(blacken(labeled))
 
     assert len("\n".join(actual).split("\n")) == 76
+
+
+@pytest.mark.parametrize(
+    ["lines", "position", "indent", "expected"],
+    (
+        pytest.param(["a", "   b", "", "c"], 1, 0, 2, id="trailing_blank"),
+        pytest.param(["a", "   b", "", "   c"], 1, 0, 4, id="inner_blank"),
+        pytest.param(["a", "   b", "   c", ""], 1, 0, 3, id="end_of_document"),
+        pytest.param(["a", "", "b"], 1, 0, 1, id="empty"),
+        pytest.param(["   a", "      b", "   c"], 1, 3, 2, id="nested"),
+    ),
+)
+def test_block_end(lines, position, indent, expected):
+    assert rst.block_end(lines, position, indent) == expected
+
+    if rst.np is not None:
+        indentation_map = rst.IndentationMap(lines)
+        assert indentation_map.block_end(position, indent) == expected
+
+
+@pytest.mark.parametrize("vectorized", (True, False))
+def test_find_block_end(monkeypatch, vectorized):
+    if vectorized:
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(rst, "np", None)
+    monkeypatch.setattr(rst, "vectorize_threshold", 4)
+
+    block = ["   line"] * 10 + [""] + ["      line"] * 300 + [""]
+    lines = LineCursor([".. note::", ""] + block * 3 + ["text"])
+    lines.advance(2)
+
+    assert rst.find_block_end(lines, 0) == len(lines.lines) - 2
+    assert ("rst" in lines.cache) is vectorized
+
+
+@pytest.mark.parametrize("vectorized", (True, False))
+@pytest.mark.parametrize("n_blank", (1, 2))
+def test_find_block_end_window_boundary(monkeypatch, vectorized, n_blank):
+    if vectorized:
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(rst, "np", None)
+    monkeypatch.setattr(rst, "vectorize_threshold", 4)
+
+    # the scanned lines end with blank lines, and the next line ends the block
+    body = ["   line"] * (4 - n_blank) + [""] * n_blank
+    lines = LineCursor([".. code:: python"] + body + ["para"])
+    lines.advance(1)
+
+    assert rst.find_block_end(lines, 0) == 1 + 4 - n_blank
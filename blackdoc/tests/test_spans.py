@@ -0,0 +1,51 @@
+import pytest
+
+from blackdoc import detect_format, format_lines, line_numbers, spans
+from blackdoc.blacken import blacken_spans
+from blackdoc.tests.data import doctest, ipython, rst
+
+
+@pytest.mark.parametrize("content", ("", "a", "a\nb", "a\n\nb\n", "\n\n"), ids=repr)
+def test_to_span(content):
+    lines = content.split("\n")
+    offsets = spans.line_offsets(content)
+
+    assert len(offsets) == len(lines)
+    for first in range(1, len(lines) + 1):
+        for last in range(first + 1, len(lines) + 2):
+            span = spans.to_span(offsets, len(content), (first, last))
+
+            assert content[span.start : span.stop] == "\n".join(
+                lines[first - 1 : last - 1]
+            )
+
+
+def test_splice():
+    content = "a\nb\nc"
+    offsets = spans.line_offsets(content)
+    first = spans.to_span(offsets, len(content), (1, 2))
+    second = spans.to_span(offsets, len(content), (2, 4))
+
+    assert spans.splice(content, [(first, "a"), (second, "b\nc")]) is content
+    assert spans.splice(content, [(first, "x"), (second, "b\nc")]) == "x\nb\nc"
+    assert spans.splice(content, [(first, "a"), (second, "y")]) == "a\ny"
+
+
+@pytest.mark.parametrize("data", (doctest, ipython, rst))
+def test_blacken_spans(data):
+    content = "\n".join(data.lines)
+    labeled = detect_format(line_numbers(content.split("\n")))
+
+    expected = "\n".join(format_lines(data.lines))
+    actual = spans.splice(content, blacken_spans(content, labeled))
+
+    assert actual == expected
+
+
+def test_blacken_spans_markdown():
+    content = "a\n```python\n10*5\n```\nb\n"
+    labeled = detect_format(line_numbers(content.split("\n")))
+
+    actual = spans.splice(content, blacken_spans(content, labeled))
+
+    assert actual == "a\n```python\n10 * 5\n```\nb\n"